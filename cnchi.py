@@ -59,6 +59,8 @@ import misc
 import log
 import info
 import updater
+import hardware_probe
+import package_list
 
 #import queue
 from multiprocessing import Queue
@@ -73,6 +75,19 @@ _alternate_package_list = ""
 # Download packages using aria2 downloader
 _use_aria2 = False
 
+# aria2 tuning profile (see data/powerpill.json)
+_aria2_profile = "default"
+
+# Install packages while the rest are still downloading (needs aria2)
+_pipelined_install = False
+
+# Decompress packages in parallel before installing them
+_predecompress = False
+
+# Install without network, from a repo made with the packages in these dirs
+_offline = False
+_local_repo_dirs = []
+
 # Enable alongside install mode (disabled by default)
 _enable_alongside = False
 
@@ -135,6 +150,11 @@ class Main(Gtk.Window):
             
             self.ui_dir = self.settings.get("UI_DIR")
             
+        # Probe the hardware while the user goes through the pages
+        # (probes have to be started before dropping privileges)
+        self.hardware_probe = hardware_probe.HardwareProbe(self.settings)
+        self.hardware_probe.start()
+
         # set enabled desktops
         self.settings.set("desktops", _desktops)
 
@@ -175,8 +195,24 @@ class Main(Gtk.Window):
 
         # save in config if we have to use aria2 to download pacman packages
         self.settings.set("use_aria2", _use_aria2)
+        self.settings.set("aria2_profile", _aria2_profile)
+        self.settings.set("pipelined_install", _pipelined_install)
+        self.settings.set("predecompress", _predecompress)
+        self.settings.set("offline", _offline)
+        if len(_local_repo_dirs) > 0:
+            self.settings.set("local_repo_dirs", _local_repo_dirs)
+        if _offline:
+            log.debug(_("Offline install, using the packages in %s") % \
+                ", ".join(self.settings.get("local_repo_dirs")))
+            # aria2 downloads from the net
+            self.settings.set("use_aria2", False)
+        elif len(_alternate_package_list) == 0:
+            # Get the package list while the user goes through the pages
+            self.package_list_prefetch = package_list.PrefetchThread(self.settings.get("TMP_DIR"))
+            self.package_list_prefetch.start()
         if _use_aria2:
             log.debug(_("Cnchi will use pm2ml and aria2 to download packages - EXPERIMENTAL"))
+            log.debug(_("Using '%s' aria2 tuning profile") % _aria2_profile)
 
         # load all pages
         # (each one is a screen, a step in the install process)
@@ -345,8 +381,9 @@ if __name__ == '__main__':
     argv = sys.argv[1:]
     
     try:
-        opts, args = getopt.getopt(argv, "adlup:",
-         ["aria2", "debug", "alongside" "update", "packages"])
+        opts, args = getopt.getopt(argv, "adlup:t:Pzo",
+         ["aria2", "debug", "alongside" "update", "packages", "aria2-profile=", "pipeline", "predecompress",
+          "offline", "local-repo="])
     except getopt.GetoptError as e:
         print(str(e))
         sys.exit(2)
@@ -364,6 +401,16 @@ if __name__ == '__main__':
             _alternate_package_list = arg
         elif opt in ('-a', '--aria2'):
             _use_aria2 = True
+        elif opt in ('-t', '--aria2-profile'):
+            _aria2_profile = arg
+        elif opt in ('-P', '--pipeline'):
+            _pipelined_install = True
+        elif opt in ('-z', '--predecompress'):
+            _predecompress = True
+        elif opt in ('-o', '--offline'):
+            _offline = True
+        elif opt == '--local-repo':
+            _local_repo_dirs.append(arg)
         elif opt in ('-l', '--alongisde'):
             _enable_alongside = True
         else:
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  generate-package-closures.py
+#  
+#  Copyright 2013 Antergos
+#  
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#  
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#  
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#  
+#  Antergos Team:
+#   Alex Filgueira (faidoc) <alexfilgueira.antergos.com>
+#   Raúl Granados (pollitux) <raulgranados.antergos.com>
+#   Gustau Castells (karasu) <karasu.antergos.com>
+#   Kirill Omelchenko (omelcheck) <omelchek.antergos.com>
+#   Marc Miralles (arcnexus) <arcnexus.antergos.com>
+#   Alex Skinner (skinner) <skinner.antergos.com>
+
+import os
+import sys
+import queue
+import shutil
+import tempfile
+import gettext
+import argparse
+import xml.etree.ElementTree as etree
+
+# Insert the src and src/pacman directories at the front of the path.
+base_dir = os.path.dirname(__file__) or '.'
+src_dir = os.path.join(base_dir, 'src')
+sys.path.insert(0, src_dir)
+sys.path.insert(0, os.path.join(src_dir, 'pacman'))
+
+import pac
+import pac_config
+import resolution_cache
+import package_closures
+import package_selection
+
+# This script resolves the packages of every desktop and hardware profile
+# and stores the results in packages.xml (see src/package_closures.py).
+# Run it with a pacman.conf that has the same repos the installer uses,
+# right after refreshing its databases: clients only use the closures if
+# their sync dbs are exactly the ones used here. Only its sync dbs are used:
+# packages are resolved against an empty root (a new system has nothing
+# installed), not against the local db of this machine.
+
+# Hardware profiles: optional packages.xml sections added to each desktop.
+# Clients resolve whatever a closure doesn't cover (filesystems, extras...),
+# so only the drivers (big, and they change what the desktop pulls in) get
+# their own profile; 'generic' covers any other combination
+_default_profiles = {
+    'generic': [],
+    'intel': [ 'intel' ],
+    'ati': [ 'ati' ],
+    'nvidia': [ 'nvidia' ],
+    'virtualbox': [ 'virtualbox' ],
+    'vmware': [ 'vmware' ],
+    'broadcom': [ 'broadcom' ] }
+
+def parse_profiles(profile_args):
+    profiles = {}
+    for arg in profile_args:
+        name, equal, sections = arg.partition('=')
+        profiles[name] = [ section for section in sections.split(',') if section ]
+    return profiles
+
+def get_empty_root_config(path, root_dir):
+    ''' Returns the config of path with its sync dbs copied to an empty
+    RootDir (and DBPath) in root_dir '''
+    conf = pac_config.PacmanConfig(path)
+    sync_dir = os.path.join(conf.options["DBPath"], "sync")
+    db_dir = os.path.join(root_dir, "var/lib/pacman")
+    os.makedirs(os.path.join(root_dir, "var/log"))
+    shutil.copytree(sync_dir, os.path.join(db_dir, "sync"))
+    conf.options["RootDir"] = root_dir
+    conf.options["DBPath"] = db_dir
+    conf.options["LogFile"] = os.path.join(root_dir, "var/log/pacman.log")
+    return conf.freeze()
+
+def get_desktops(root):
+    return [ child.tag[:-len('_desktop')] for child in root if child.tag.endswith('_desktop') ]
+
+def add_closures(p, root, snapshot, desktops, profiles):
+    index = package_selection.compile_index(root)
+
+    closures = etree.SubElement(root, 'closures', snapshot=snapshot)
+
+    for desktop in desktops:
+        for profile in sorted(profiles.keys()):
+            package_names, conflicts = package_closures.get_package_names(index, desktop, profiles[profile])
+            to_add, to_remove, explicit = p.resolve(package_names, conflicts)
+            if len(to_add) == 0:
+                print("Can't resolve %s (%s)" % (desktop, profile))
+                continue
+            closures.append(package_closures.create_closure_element(desktop, profile, \
+                package_names, conflicts, pac.sort_by_dependencies(to_add), explicit, \
+                [ pkg.name for pkg in to_remove ]))
+            print("%s (%s): %d packages" % (desktop, profile, len(to_add)))
+
+    return closures
+
+if __name__ == '__main__':
+    gettext.install("cnchi")
+
+    parser = argparse.ArgumentParser(description="Adds precomputed package closures to packages.xml")
+    parser.add_argument("-c", "--config", required=True, help="pacman.conf to use")
+    parser.add_argument("-i", "--input", default=os.path.join(base_dir, "data", "packages.xml"))
+    parser.add_argument("-o", "--output", help="defaults to the input file")
+    parser.add_argument("-d", "--desktop", action="append", help="desktop (default: all of them)")
+    parser.add_argument("-p", "--profile", action="append",
+        help="hardware profile, as name=section,section... (default: some common ones)")
+    args = parser.parse_args()
+
+    tree = etree.parse(args.input)
+    root = tree.getroot()
+
+    for old_closures in root.findall('closures'):
+        root.remove(old_closures)
+
+    desktops = args.desktop or get_desktops(root)
+    if args.profile:
+        profiles = parse_profiles(args.profile)
+    else:
+        profiles = _default_profiles
+
+    root_dir = tempfile.mkdtemp(prefix="cnchi-closures-")
+    try:
+        p = pac.Pac(get_empty_root_config(args.config, root_dir), queue.Queue())
+        sync_dir = os.path.join(p.pacman_conf.options["DBPath"], "sync")
+        snapshot = resolution_cache.hash_databases(sync_dir)
+        add_closures(p, root, snapshot, desktops, profiles)
+    finally:
+        shutil.rmtree(root_dir)
+
+    tree.write(args.output or args.input, encoding="UTF-8", xml_declaration=True)
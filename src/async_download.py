@@ -0,0 +1,410 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  async_download.py
+#
+#  Copyright 2013 Antergos
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#  Antergos Team:
+#   Alex Filgueira (faidoc) <alexfilgueira.antergos.com>
+#   Raúl Granados (pollitux) <raulgranados.antergos.com>
+#   Gustau Castells (karasu) <karasu.antergos.com>
+#   Kirill Omelchenko (omelcheck) <omelchek.antergos.com>
+#   Marc Miralles (arcnexus) <arcnexus.antergos.com>
+#   Alex Skinner (skinner) <skinner.antergos.com>
+
+''' Pure python package downloader, used when aria2 is not available.
+
+Downloads many packages at the same time. Big packages are split in byte
+ranges that are fetched from different mirrors. Every file is checked
+against the size and checksum stored in the sync database before it is
+moved into the cache dir. '''
+
+import os
+import ssl
+import queue
+import asyncio
+import urllib.parse
+
+import log
+import package_cache
+import download_telemetry
+import package_verify
+
+# Max simultaneous connections (total and per mirror)
+_max_connections = 8
+_max_connections_per_host = 2
+
+# Packages bigger than this are split in ranges of this size
+_split_size = 4 * 1024 * 1024
+
+# Seconds to wait for a mirror before trying the next one
+_timeout = 30
+
+_max_redirects = 5
+
+_block_size = 65536
+
+# Times a corrupt file is downloaded again before giving up
+_max_verify_retries = 2
+
+class HTTPError(Exception):
+    def __init__(self, value):
+        self.value = value
+    def __str__(self):
+        return repr(self.value)
+
+class AsyncDownloader(object):
+    def __init__(self, download_queue, cache_dir, callback_queue=None, file_callback=None, telemetry=None, verifier=None):
+        self.download_queue = download_queue
+        self.cache_dir = cache_dir
+        self.callback_queue = callback_queue
+        self.file_callback = file_callback
+
+        self.last_event = {}
+
+        self.total_length = sum([ item['size'] for item in download_queue ])
+        self.completed_length = 0
+
+        self.completed = []
+        self.failed = []
+
+        self.host_semaphores = {}
+        self.semaphore = None
+
+        if telemetry == None:
+            self.telemetry = download_telemetry.DownloadTelemetry()
+        else:
+            self.telemetry = telemetry
+        self.telemetry.add_total_length(self.total_length)
+
+        # Checksums are computed in other processes, not to block the loop
+        if verifier == None:
+            self.verifier = package_verify.PackageVerifier(on_verified=file_callback)
+        else:
+            self.verifier = verifier
+
+    def run(self):
+        ''' Downloads all files. Returns the lists of completed and failed ones '''
+        if len(self.download_queue) == 0:
+            return self.completed, self.failed
+
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(self.download_all())
+        finally:
+            loop.close()
+
+        if len(self.failed) > 0:
+            log.debug(_("%d files could not be downloaded") % len(self.failed))
+
+        return self.completed, self.failed
+
+    async def download_all(self):
+        self.semaphore = asyncio.Semaphore(_max_connections)
+        stats_task = asyncio.ensure_future(self.send_stats())
+        tasks = [ self.download_file(item) for item in self.download_queue ]
+        await asyncio.gather(*tasks)
+        stats_task.cancel()
+
+    async def send_stats(self):
+        ''' Sends the download statistics once per second '''
+        while True:
+            await asyncio.sleep(1)
+            self.telemetry.sample()
+            self.queue_event('download_stats', self.telemetry.get_stats())
+
+    def get_host_semaphore(self, url):
+        host = urllib.parse.urlsplit(url).netloc
+        if host not in self.host_semaphores:
+            self.host_semaphores[host] = asyncio.Semaphore(_max_connections_per_host)
+        return self.host_semaphores[host]
+
+    def get_ranges(self, size):
+        if size <= _split_size:
+            return [ (0, size) ]
+        ranges = []
+        for start in range(0, size, _split_size):
+            ranges.append((start, min(start + _split_size, size)))
+        return ranges
+
+    async def download_file(self, item):
+        path = os.path.join(self.cache_dir, item['filename'])
+        part_path = path + ".part"
+        urls = item['urls']
+
+        if len(urls) == 0:
+            self.failed.append(item['filename'])
+            return
+
+        self.telemetry.start_package(item['filename'], item['size'])
+
+        for attempt in range(_max_verify_retries + 1):
+            ok = await self.download_parts(item, part_path)
+            if not ok:
+                break
+            # A corrupt file is downloaded again right away
+            part_path, ok, reason = await self.verifier.verify_async(
+                asyncio.get_event_loop(), part_path, item)
+            if ok:
+                break
+            log.debug(_("Package %s is corrupt (%s), downloading it again") % (item['filename'], reason))
+            self.add_progress(-item['size'])
+
+        if not ok:
+            log.debug(_("Error downloading %s") % item['filename'])
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            self.failed.append(item['filename'])
+            self.telemetry.end_package(item['filename'], False)
+            return
+
+        self.telemetry.end_package(item['filename'], True)
+
+        os.rename(part_path, path)
+        self.completed.append(item['filename'])
+
+        # This calls file_callback
+        self.verifier.add_verified(path, item)
+
+    async def download_parts(self, item, part_path):
+        ''' Downloads all ranges of a file. Returns False if any of them
+        could not be downloaded from any mirror '''
+        urls = item['urls']
+
+        with open(part_path, "wb") as f:
+            f.truncate(item['size'])
+
+        # Each range starts with a different mirror, so a big package
+        # is downloaded from several mirrors at the same time
+        ranges = self.get_ranges(item['size'])
+        tasks = []
+        for i in range(len(ranges)):
+            start, end = ranges[i]
+            mirrors = urls[i % len(urls):] + urls[:i % len(urls)]
+            tasks.append(self.download_range(item, part_path, mirrors, start, end))
+
+        results = await asyncio.gather(*tasks)
+        return False not in results
+
+    async def download_range(self, item, part_path, mirrors, start, end):
+        ''' Downloads bytes [start, end) of a file trying all mirrors in order '''
+        for url in mirrors:
+            downloaded = [ 0 ]
+            try:
+                async with self.semaphore:
+                    async with self.get_host_semaphore(url):
+                        self.queue_event('action', _("Downloading package '%s'...") % item['name'])
+                        await self.fetch(url, item['filename'], part_path, start, end, item['size'], downloaded)
+                return True
+            except (HTTPError, OSError, EOFError, asyncio.TimeoutError, ValueError) as e:
+                log.debug(_("Can't download %s: %s") % (url, e))
+                # Forget what we have got from this mirror
+                host = download_telemetry.get_host(url)
+                self.telemetry.add_bytes(item['filename'], host, -downloaded[0])
+                self.telemetry.add_failure(host)
+                self.add_progress(-downloaded[0])
+        return False
+
+    async def open_connection(self, url):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme == "https":
+            port = parts.port or 443
+            ssl_context = ssl.create_default_context()
+        elif parts.scheme == "http":
+            port = parts.port or 80
+            ssl_context = None
+        else:
+            raise HTTPError("Unsupported protocol: %s" % url)
+
+        connection = asyncio.open_connection(parts.hostname, port, ssl=ssl_context)
+        reader, writer = await asyncio.wait_for(connection, _timeout)
+        return parts, reader, writer
+
+    async def fetch(self, url, filename, part_path, start, end, size, downloaded):
+        for redirect in range(_max_redirects):
+            parts, reader, writer = await self.open_connection(url)
+            try:
+                request_path = parts.path or "/"
+                if parts.query:
+                    request_path += "?" + parts.query
+                request = "GET %s HTTP/1.1\r\n" % request_path
+                request += "Host: %s\r\n" % parts.netloc
+                request += "User-Agent: Cnchi\r\n"
+                request += "Connection: close\r\n"
+                if start != 0 or end != size:
+                    request += "Range: bytes=%d-%d\r\n" % (start, end - 1)
+                request += "\r\n"
+                writer.write(request.encode())
+
+                status, headers = await self.read_headers(reader)
+
+                if status in [ 301, 302, 303, 307, 308 ] and 'location' in headers:
+                    url = urllib.parse.urljoin(url, headers['location'])
+                    continue
+
+                if status == 200 and (start != 0 or end != size):
+                    raise HTTPError("%s doesn't support byte ranges" % parts.netloc)
+                if status not in [ 200, 206 ]:
+                    raise HTTPError("HTTP error %d" % status)
+
+                host = download_telemetry.get_host(url)
+                await self.read_body(reader, headers, filename, host, part_path, start, end, downloaded)
+                return
+            finally:
+                writer.close()
+
+        raise HTTPError("Too many redirects")
+
+    async def read_headers(self, reader):
+        line = await asyncio.wait_for(reader.readline(), _timeout)
+        fields = line.decode('latin-1').split()
+        if len(fields) < 2:
+            raise HTTPError("Bad HTTP response")
+        status = int(fields[1])
+
+        headers = {}
+        while True:
+            line = await asyncio.wait_for(reader.readline(), _timeout)
+            line = line.decode('latin-1').strip()
+            if len(line) == 0:
+                break
+            key, colon, value = line.partition(':')
+            headers[key.strip().lower()] = value.strip()
+
+        return status, headers
+
+    async def read_body(self, reader, headers, filename, host, part_path, start, end, downloaded):
+        length = end - start
+        with open(part_path, "r+b") as f:
+            f.seek(start)
+            if headers.get('transfer-encoding', '').lower() == "chunked":
+                while True:
+                    line = await asyncio.wait_for(reader.readline(), _timeout)
+                    chunk_size = int(line.split(b';')[0], 16)
+                    if chunk_size == 0:
+                        break
+                    data = await asyncio.wait_for(reader.readexactly(chunk_size), _timeout)
+                    await asyncio.wait_for(reader.readline(), _timeout)
+                    self.write_block(f, data, length, downloaded)
+                    self.telemetry.add_bytes(filename, host, len(data))
+            else:
+                while downloaded[0] < length:
+                    data = await asyncio.wait_for(reader.read(_block_size), _timeout)
+                    if len(data) == 0:
+                        break
+                    self.write_block(f, data, length, downloaded)
+                    self.telemetry.add_bytes(filename, host, len(data))
+
+        if downloaded[0] != length:
+            raise HTTPError("Got %d bytes instead of %d" % (downloaded[0], length))
+
+    def write_block(self, f, data, length, downloaded):
+        if downloaded[0] + len(data) > length:
+            raise HTTPError("Server has sent more data than expected")
+        f.write(data)
+        downloaded[0] += len(data)
+        self.add_progress(len(data))
+
+    def add_progress(self, length):
+        self.completed_length += length
+        if self.total_length > 0:
+            percent = float(self.completed_length / self.total_length)
+            # Round it a bit, not to flood the queue with events
+            self.queue_event('percent', round(percent, 3))
+
+    def queue_event(self, event_type, event_text=""):
+        if self.callback_queue is None:
+            return
+
+        if event_type in self.last_event:
+            if self.last_event[event_type] == event_text:
+                # do not repeat same event
+                return
+
+        self.last_event[event_type] = event_text
+
+        try:
+            self.callback_queue.put_nowait((event_type, event_text))
+        except queue.Full:
+            pass
+
+class DownloadPackages(object):
+    ''' Same interface as download.DownloadPackages, but it uses Pac to
+    refresh the databases and to resolve dependencies, and AsyncDownloader
+    to download the packages '''
+    def __init__(self, pac, package_names, cache_dir, callback_queue=None, file_callback=None, \
+                 run=True, conflicts=None, local_cache_dirs=None):
+        self.pac = pac
+        self.cache_dir = cache_dir
+        self.callback_queue = callback_queue
+        self.file_callback = file_callback
+
+        if conflicts == None:
+            self.conflicts = []
+        else:
+            self.conflicts = conflicts
+
+        self.local_cache_dirs = []
+        if local_cache_dirs != None:
+            for cache_dir in local_cache_dirs:
+                if os.path.normpath(cache_dir) != os.path.normpath(self.cache_dir):
+                    self.local_cache_dirs.append(cache_dir)
+
+        # Download queues we don't have to resolve (see add_precomputed)
+        self.precomputed = {}
+
+        if run:
+            self.run(package_names)
+
+    def is_available(self):
+        return True
+
+    def run(self, package_names):
+        self.refresh_databases()
+        self.download_packages(package_names)
+
+    def refresh_databases(self):
+        self.pac.do_refresh(parallel=True)
+
+    def add_precomputed(self, package_names, download_queue):
+        ''' Sets the download queue of package_names (for instance, from a
+        closure published in packages.xml), so it isn't resolved again '''
+        self.precomputed[frozenset(package_names)] = download_queue
+
+    def download_packages(self, package_names):
+        download_queue = self.precomputed.get(frozenset(package_names))
+        if download_queue == None:
+            pkgs, explicit = self.pac.get_install_order(package_names, self.conflicts)
+            download_queue = self.pac.get_download_queue(pkgs)
+        verifier = package_verify.PackageVerifier(on_verified=self.file_callback)
+
+        # Files we already have have been checked against the sync db
+        items = {}
+        for item in download_queue:
+            items[item['filename']] = item
+        local_file_callback = lambda path: verifier.add_verified(path, items[os.path.basename(path)])
+
+        download_queue = package_cache.seed_download_queue(download_queue, \
+            self.cache_dir, self.local_cache_dirs, local_file_callback)
+        downloader = AsyncDownloader(download_queue, self.cache_dir, \
+            self.callback_queue, verifier=verifier)
+        downloader.run()
+        downloader.telemetry.finish()
+        downloader.telemetry.write_summary()
+        verifier.shutdown()
@@ -121,7 +121,8 @@ class Check(Gtk.Box):
         return state == NM_STATE_CONNECTED_GLOBAL
 
     def check_all(self):
-        has_internet = self.has_connection()
+        # Offline installs don't need a network at all
+        has_internet = self.settings.get("offline") or self.has_connection()
         self.prepare_network_connection.set_state(has_internet)       
 
         on_power = not self.on_battery()
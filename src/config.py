@@ -70,7 +70,14 @@ class Settings():
             'encrypt_home' : False, \
             'user_info_done' : False, \
             'rankmirrors_done' : False, \
-            'use_aria2' : False })
+            'use_aria2' : False, \
+            'aria2_profile' : 'default', \
+            'pipelined_install' : False, \
+            'predecompress' : False, \
+            'offline' : False, \
+            'local_repo_dirs' : ['/packages'], \
+            'hardware' : None, \
+            'hardware_probing' : False })
 
     def _get_settings(self):
         gd = self.settings.get()
@@ -90,6 +97,6 @@ class Settings():
         return d[key]
         
     def set(self, key, value):
-        d = self._get_settings()
-        d[key] = value
-        self._update_settings(d)
+        # Only update key, so a thread setting another key at the same
+        # time doesn't get its value overwritten by our (older) copy
+        self._update_settings({ key : value })
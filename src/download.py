@@ -28,7 +28,15 @@
 #   Marc Miralles (arcnexus) <arcnexus.antergos.com>
 #   Alex Skinner (skinner) <skinner.antergos.com>
 
-import pm2ml
+try:
+    import pm2ml
+except ImportError:
+    pm2ml = None
+import download_monitor
+import package_verify
+import resolution_cache
+import package_cache
+import download_telemetry
 import sys
 import os
 import time
@@ -36,11 +44,97 @@ import subprocess
 import log
 import xmlrpc.client
 import queue
+import json
+import collections
+import xml.etree.ElementTree as etree
+
+from pacman import pac
 
 _test = False
 
+# Default seconds between two aria2 status queries
+_poll_interval = 0.5
+
+_aria2_path = "/usr/bin/aria2c"
+
+# aria2 tuning profiles are stored in this file
+_profiles_file = "/usr/share/cnchi/data/powerpill.json"
+_default_profile = "default"
+
+# aria2 session file (it's saved in the cache dir)
+_session_filename = ".cnchi-aria2.session"
+
+# Times a corrupt file is downloaded again before giving up
+_max_verify_retries = 2
+
+# Used if we can't read the profiles file
+_fallback_tuning_args = [
+    "--max-concurrent-downloads=5",
+    "--max-connection-per-server=1",
+    "--split=1",
+    "--file-allocation=none"]
+
+def merge_aria2_args(args, new_args):
+    ''' Returns args with new_args added. An option in new_args replaces
+    the option with the same name in args '''
+    merged = collections.OrderedDict()
+    for arg in args + new_args:
+        name = arg.partition('=')[0]
+        merged[name] = arg
+    return list(merged.values())
+
+def load_aria2_profile(profiles_file, profile):
+    ''' Loads aria2 tuning arguments from a powerpill.json file.
+    The generic aria2 args of the file are used as a base and the args
+    of the selected profile are applied on top of them '''
+    if profile == None:
+        profile = _default_profile
+
+    try:
+        with open(profiles_file, "rt") as f:
+            aria2_conf = json.load(f)["aria2"]
+    except (IOError, ValueError, KeyError) as e:
+        log.debug(_("Can't load aria2 profiles from %s: %s") % (profiles_file, e))
+        return list(_fallback_tuning_args)
+
+    args = aria2_conf.get("args", [])
+    profiles = aria2_conf.get("profiles", {})
+
+    if profile not in profiles:
+        log.debug(_("Unknown aria2 profile '%s', using '%s' instead") % (profile, _default_profile))
+        profile = _default_profile
+
+    return merge_aria2_args(args, profiles.get(profile, []))
+
+def sort_download_queue(download_queue, package_names):
+    ''' Sorts a download queue following the order of package_names.
+    Packages not in package_names go to the end '''
+    position = {}
+    for i in range(len(package_names)):
+        position.setdefault(package_names[i], i)
+    last = len(package_names)
+    download_queue.sort(key=lambda item: position.get(item['name'], last))
+
+def download_queue_to_metalink(download_queue):
+    ''' Creates a metalink (v4) document from a download queue '''
+    metalink = etree.Element('metalink', xmlns="urn:ietf:params:xml:ns:metalink")
+    for item in download_queue:
+        f = etree.SubElement(metalink, 'file', name=item['filename'])
+        # Sizes (and hashes) of databases are not known beforehand
+        if item['size'] != None:
+            etree.SubElement(f, 'size').text = str(item['size'])
+        if item['sha256sum']:
+            etree.SubElement(f, 'hash', type="sha-256").text = item['sha256sum']
+        if item['md5sum']:
+            etree.SubElement(f, 'hash', type="md5").text = item['md5sum']
+        for i in range(len(item['urls'])):
+            url = etree.SubElement(f, 'url', priority=str(i + 1))
+            url.text = item['urls'][i]
+    return '<?xml version="1.0" encoding="utf-8"?>\n' + \
+        etree.tostring(metalink, encoding="unicode")
+
 class DownloadPackages():
-    def __init__(self, package_names, conf_file=None, cache_dir=None, databases_dir=None, callback_queue=None):
+    def __init__(self, package_names, conf_file=None, cache_dir=None, databases_dir=None, callback_queue=None, batch=True, poll_interval=None, profile=None, profiles_file=None, file_callback=None, run=True, conflicts=None, resolution_cache_dir=None, local_cache_dirs=None, pacman_conf=None):
         if conf_file == None:
             self.conf_file = "/etc/pacman.conf"
         else:
@@ -56,117 +150,291 @@ class DownloadPackages():
         else:
             self.databases_dir = databases_dir
             
+        # Already parsed pacman.conf (see pac_config.FrozenPacmanConfig). If
+        # we have it, we use it instead of pm2ml, which would parse it again
+        self.pacman_conf = pacman_conf
+
         self.last_event = {}
 
         self.callback_queue = callback_queue
 
+        # Called with the path of each downloaded file
+        self.file_callback = file_callback
+
+        self.batch = batch
+
+        if conflicts == None:
+            self.conflicts = []
+        else:
+            self.conflicts = conflicts
+
+        # Other cache dirs where we may find the packages we need
+        self.local_cache_dirs = []
+        if local_cache_dirs != None:
+            for cache_dir in local_cache_dirs:
+                if os.path.normpath(cache_dir) != os.path.normpath(self.cache_dir):
+                    self.local_cache_dirs.append(cache_dir)
+
+        if resolution_cache_dir == None:
+            self.resolution_cache = None
+        else:
+            self.resolution_cache = resolution_cache.ResolutionCache(resolution_cache_dir, self.databases_dir)
+
+        if poll_interval == None:
+            self.poll_interval = _poll_interval
+        else:
+            self.poll_interval = poll_interval
+
+        self.profile = profile
+
+        if profiles_file == None:
+            self.profiles_file = _profiles_file
+        else:
+            self.profiles_file = profiles_file
+
+        # aria2 stores here what is left to download (if we are restarted)
+        self.session_file = os.path.join(self.cache_dir, _session_filename)
+        self.restored = {}
+
+        # Download queues we don't have to resolve (see add_precomputed)
+        self.precomputed = {}
+
+        self.telemetry = None
+
+        # Packages are verified as soon as they are downloaded
+        self.verifier = None
+        self.monitor = None
+        self.items = {}
+        self.retries = {}
+        self.verify_ok = True
+
         self.set_aria2_defaults()
 
-        self.run_aria2_as_daemon()
+        self.server = None
+
+        if pm2ml == None and self.pacman_conf == None:
+            print(_("pm2ml is not installed. Won't be able to speed up the download"))
+            return
+
+        if not self.run_aria2_as_daemon():
+            return
 
         aria2_url = 'http://%s:%s@localhost:%s/rpc' % (self.rpc_user, self.rpc_passwd, self.rpc_port)
+        self.aria2_ws_url = 'ws://localhost:%s/jsonrpc' % self.rpc_port
 
         try:
-            s = xmlrpc.client.ServerProxy(aria2_url)
-        except (xmlrpc.client.Fault, ConnectionRefusedError, BrokenPipeError) as e:
+            server = xmlrpc.client.ServerProxy(aria2_url)
+            self.wait_for_aria2(server)
+            self.server = server
+        except (xmlrpc.client.Fault, OSError) as e:
             print(_("Can't connect to Aria2. Won't be able to speed up the download:"))
             print(e)
             return
 
+        self.restore_session()
+
+        if run:
+            self.run(package_names)
+
+    def run(self, package_names):
         # first, update pacman databases
-        package_names = ["databases"] + package_names
-        
-        for package_name in package_names:
-            metalink = self.create_metalink(package_name)
-            if metalink == None:
-                log.debug(_("Error creating metalink for package %s") % package_name)
+        self.refresh_databases()
+        self.download_packages(package_names)
+
+    def refresh_databases(self):
+        if self.server != None:
+            self.download_databases(self.server)
+
+    def download_packages(self, package_names):
+        ''' Downloads package_names (and their dependencies). Files are
+        downloaded following the order of package_names '''
+        if self.server == None:
+            return
+
+        # Only package downloads are measured (not the databases)
+        self.telemetry = download_telemetry.DownloadTelemetry()
+        self.telemetry_base_length = 0
+        self.gid_lengths = {}
+
+        self.verifier = package_verify.PackageVerifier(on_verified=self.file_callback)
+        self.verify_ok = True
+
+        if self.batch:
+            ok = self.download_files(self.server, package_names)
+        else:
+            ok = True
+            for package_name in package_names:
+                if not self.download_files(self.server, [package_name]):
+                    log.debug(_("Error downloading package %s") % package_name)
+                    ok = False
+
+        self.forget_restored_downloads()
+
+        self.verifier.wait()
+        self.verifier.shutdown()
+        self.verifier = None
+
+        if ok and self.verify_ok:
+            self.remove_session()
+
+        self.telemetry.finish()
+        self.telemetry.write_summary()
+
+    def add_precomputed(self, package_names, download_queue):
+        ''' Sets the download queue of package_names (for instance, from a
+        closure published in packages.xml), so it isn't resolved again '''
+        self.precomputed[frozenset(package_names)] = download_queue
+
+    def download_databases(self, s):
+        # Databases are always downloaded again
+        self.forget_restored_downloads(lambda filename: ".db" in filename)
+
+        metalink = self.create_databases_metalink()
+        if metalink == None:
+            log.debug(_("Error creating metalink for the databases"))
+            return
+
+        gids = self.add_metalink(s, metalink)
+
+        if len(gids) <= 0:
+            log.debug(_("Error adding metalink for the databases"))
+            return
+
+        self.wait_for_gids(s, gids)
+
+    def download_files(self, s, package_names):
+        ''' Downloads all files needed to install package_names using one
+        metalink. Returns False if something went wrong '''
+        download_queue = self.get_download_queue(package_names)
+        if download_queue == None:
+            return False
+
+        # Do not add again the downloads restored from a previous session
+        download_queue, gids = self.adopt_restored_downloads(download_queue)
+
+        ok = True
+        if len(download_queue) > 0:
+            metalink = download_queue_to_metalink(download_queue)
+            new_gids = self.add_metalink(s, metalink, { 'dir': self.cache_dir })
+            if len(new_gids) <= 0:
+                ok = False
+            gids += new_gids
+
+        while len(gids) > 0:
+            completed, failed = self.wait_for_gids(s, gids)
+            if len(failed) > 0:
+                ok = False
+            # Some files may still be being checked
+            gids = []
+            if self.verifier != None:
+                self.verifier.wait()
+                gids = self.requeue_corrupt(s)
+
+        return ok and self.verify_ok
+
+    def requeue_corrupt(self, s):
+        ''' Downloads again the files that have failed verification.
+        Returns their new gids '''
+        download_queue = []
+        for item in self.verifier.pop_corrupt():
+            retries = self.retries.get(item['filename'], 0)
+            if retries >= _max_verify_retries:
+                log.debug(_("Package %s is still corrupt, giving up") % item['filename'])
+                self.verify_ok = False
                 continue
-            
-            gids = self.add_metalink(s, metalink)
-            
-            if len(gids) <= 0:
-                log.debug(_("Error adding metalink for package %s") % package_name)
+            self.retries[item['filename']] = retries + 1
+            download_queue.append(item)
+
+        if len(download_queue) == 0:
+            return []
+
+        metalink = download_queue_to_metalink(download_queue)
+        gids = self.add_metalink(s, metalink, { 'dir': self.cache_dir })
+        if len(gids) <= 0:
+            self.verify_ok = False
+        return gids
+
+    def wait_for_gids(self, s, gids):
+        ''' Waits until all gids are done, reporting aggregate progress '''
+        if self.telemetry != None:
+            self.telemetry_base_length = self.telemetry.total_length
+        monitor = download_monitor.DownloadMonitor(
+            s, gids,
+            ws_url=self.aria2_ws_url,
+            interval=self.poll_interval,
+            callback=self.on_progress)
+        self.monitor = monitor
+        completed, failed = monitor.run()
+        self.monitor = None
+        if len(failed) > 0:
+            log.debug(_("%d files could not be downloaded") % len(failed))
+        return completed, failed
+
+    def on_progress(self, progress):
+        ''' Called by the download monitor once per tick '''
+        active = list(progress['active'].values())
+        if len(active) == 1:
+            basename = active[0]
+            if basename.endswith(".pkg.tar.xz"):
+                basename = basename[:-11]
+            action = _("Downloading package '%s'...") % basename
+            self.queue_event('action', action)
+        elif len(active) > 1:
+            action = _("Downloading %d packages...") % len(active)
+            self.queue_event('action', action)
+
+        total = progress['total_length']
+        if total > 0:
+            percent = float(progress['completed_length'] / total)
+            self.queue_event('percent', percent)
+
+        for path in progress['completed_files']:
+            item = self.items.get(os.path.basename(path))
+            if self.verifier != None and item != None:
+                self.verifier.submit(path, item)
+            elif self.file_callback != None:
+                self.file_callback(path)
+
+        # Corrupt files are downloaded again right away
+        if self.verifier != None and self.monitor != None:
+            self.monitor.add_gids(self.requeue_corrupt(self.server))
+
+        if self.telemetry != None:
+            self.update_telemetry(progress)
+
+    def update_telemetry(self, progress):
+        self.telemetry.total_length = self.telemetry_base_length + progress['total_length']
+
+        for gid, download in progress['downloads'].items():
+            if download['path'] == None:
                 continue
+            filename = os.path.basename(download['path'])
+            self.telemetry.start_package(filename, download['total_length'])
+
+            completed_length = download['completed_length']
+            if completed_length != None:
+                host = download['host'] or "unknown"
+                delta = completed_length - self.gid_lengths.get(gid, 0)
+                if delta != 0:
+                    self.telemetry.add_bytes(filename, host, delta)
+                self.gid_lengths[gid] = completed_length
 
-            all_gids_done = False
-                      
-            while all_gids_done == False:
-                all_gids_done = True
-                gids_to_remove = []
-                for gid in gids:
-                    total = 0
-                    completed = 0
-                    old_percent = -1
-                    
-                    try:
-                        r = s.aria2.tellStatus(gid)
-                    except xmlrpc.client.Fault as e:
-                        print(e)
-                        gids_to_remove.append(gid)
-                        continue
-                    
-                    # remove completed gid's
-                    if r['status'] == "complete":
-                        s.aria2.removeDownloadResult(gid)
-                        gids_to_remove.append(gid)
-                        continue
-
-                    # if gid is not active, go to the next gid
-                    if r['status'] != "active":
-                        continue
-
-                    all_gids_done = False
-
-                    totalLength = int(r['totalLength'])
-                    files = r['files']
-                    if totalLength == 0:
-                        totalLength = int(files[0]['length'])
-                    total += totalLength
-
-                    if total <= 0:
-                        continue
-                        
-                    # Get first uri to get the real package name
-                    # (we need to use this if we want to show individual
-                    # packages from metapackages like base or base-devel)
-                    uri = files[0]['uris'][0]['uri']
-                    basename = os.path.basename(uri)
-                    if basename.endswith(".pkg.tar.xz"):
-                        basename = basename[:-11]
-                    
-                    action = _("Downloading package '%s'...") % basename
-                    self.queue_event('action', action)
-
-                    while r['status'] == "active" :
-                        r = s.aria2.tellStatus(gid)
-                        completed = int(r['completedLength'])
-                        percent = float(completed / total)
-                        if percent != old_percent:
-                            self.queue_event('percent', percent)
-                            old_percent = percent
-                            
-                gids = self.remove_old_gids(gids, gids_to_remove)
-
-    def remove_old_gids(self, gids, gids_to_remove):
-        new_gids_list = []
-        for gid in gids:
-            if gid not in gids_to_remove:
-                new_gids_list.append(gid)
-        return new_gids_list
+            if download['status'] == "complete":
+                self.telemetry.end_package(filename, True)
+            elif download['status'] in [ "error", "removed" ]:
+                self.telemetry.end_package(filename, False)
+
+        self.telemetry.sample()
+        self.queue_event('download_stats', self.telemetry.get_stats())
 
     def set_aria2_defaults(self):
         self.rpc_user = "antergos"
         self.rpc_passwd = "antergos"
         self.rpc_port = "6800"
         
-        self.aria2_args = [
+        # Options that don't depend on the tuning profile
+        fixed_args = [
             "--log=/tmp/download-aria2.log",
-            #"--max-concurrent-downloads=1",
-            #"--split=5",
-            #"--min-split-size=5M",
-            #"--max-connection-per-server=2",
-            #"--check-integrity",
-            #"--continue=false",
             "--enable-rpc",
             "--rpc-user=%s" % self.rpc_user,
             "--rpc-passwd=%s" % self.rpc_passwd,
@@ -174,42 +442,63 @@ class DownloadPackages():
             "--rpc-save-upload-metadata=false",
             "--rpc-max-request-size=4M",
             "--allow-overwrite=true",
-            #"--always-resume=false",
-            #"--auto-save-interval=0",
             "--log-level=notice",
             "--show-console-readout=false",
-            #"--summary-interval=0",
             "--no-conf",
             "--quiet",
-            #"--remove-control-file",
             "--stop-with-process=%d" % os.getpid(),
             "--auto-file-renaming=false",
-            #"--conditional-get=true",
-            #"--metalink-file=/tmp/packages.metalink",
-            #"--pause",
+            # Partial files (and the session) are always resumed, whatever
+            # the profiles file says
+            "--continue=true",
+            "--always-resume=true",
+            "--conditional-get=false",
+            "--check-integrity=true",
+            "--save-session=%s" % self.session_file,
+            "--save-session-interval=10",
             "--dir=%s" % self.databases_dir]
+
+        # Resume the unfinished downloads of a previous run
+        self.session_restored = False
+        if os.path.exists(self.session_file) and os.path.getsize(self.session_file) > 0:
+            fixed_args.append("--input-file=%s" % self.session_file)
+            self.session_restored = True
+
+        tuning_args = load_aria2_profile(self.profiles_file, self.profile)
+
+        self.aria2_args = merge_aria2_args(tuning_args, fixed_args)
             
     def run_aria2_as_daemon(self):
-        aria2_cmd = ['/usr/bin/aria2c'] + self.aria2_args + ['--daemon=true']
-        aria2c_p = subprocess.Popen(aria2_cmd)
-        aria2c_p.wait()
+        aria2_cmd = [_aria2_path] + self.aria2_args + ['--daemon=true']
+        try:
+            aria2c_p = subprocess.Popen(aria2_cmd)
+            aria2c_p.wait()
+        except OSError as e:
+            print(_("Can't run aria2. Won't be able to speed up the download:"))
+            print(e)
+            return False
+        return True
 
-    def create_metalink(self, package_name):
-        args = str("-c %s" % self.conf_file).split() 
-        
-        if package_name == "databases":
-            args += ["-y"]
-        else:
-            args += [package_name]
-        
-        args += ["--noconfirm"]
-        args += "-r -p http -l 50".split()
-        
+    def wait_for_aria2(self, server):
+        ''' The aria2 daemon may need a moment to start listening '''
+        for retry in range(10):
+            try:
+                server.aria2.getVersion()
+                return
+            except ConnectionRefusedError:
+                time.sleep(0.5)
+        server.aria2.getVersion()
+
+    def is_available(self):
+        ''' Returns False if we can't use aria2 at all '''
+        return self.server != None
+
+    def run_pm2ml(self, args):
         try:
             pargs, conf, download_queue, not_found, missing_deps = pm2ml.build_download_queue(args)
         except:
-            log.debug(_("Unable to create download queue for package %s") % package_name)
-            return None  
+            log.debug(_("Unable to create download queue with pm2ml %s") % " ".join(args))
+            return None, None
 
         if not_found:
             log.debug(_("Warning! Can't find these packages:"))
@@ -220,20 +509,214 @@ class DownloadPackages():
             log.debug(_("Warning! Can't resolve these dependencies:"))
             for md in sorted(missing_deps):
                 log.debug(md)
-      
-        metalink = pm2ml.download_queue_to_metalink(
-            download_queue,
-            output_dir=pargs.output_dir,
-            set_preference=pargs.preference
-        )        
+
+        return pargs, download_queue
+
+    def get_pm2ml_args(self):
+        args = str("-c %s" % self.conf_file).split() 
+        args += ["--noconfirm"]
+        args += "-r -p http -l 50".split()
+        return args
+
+    def resolve(self, package_names):
+        ''' Returns the list of files to download to install package_names.
+        Each file is a dict with the package name, filename, size, checksums
+        and urls '''
+        download_queue = self.precomputed.get(frozenset(package_names))
+        if download_queue != None:
+            log.debug(_("Using precomputed download queue"))
+            return [ dict(item) for item in download_queue ]
+
+        if self.resolution_cache != None:
+            download_queue = self.resolution_cache.get(package_names, self.conflicts)
+            if download_queue != None:
+                log.debug(_("Using cached download queue"))
+                return download_queue
+
+        if self.pacman_conf != None:
+            download_queue = self.resolve_with_alpm(package_names)
+        else:
+            download_queue = self.resolve_with_pm2ml(package_names)
+        if download_queue == None:
+            return None
+
+        if self.resolution_cache != None:
+            self.resolution_cache.put(package_names, self.conflicts, download_queue)
+
+        return download_queue
+
+    def resolve_with_pm2ml(self, package_names):
+        pargs, pm2ml_queue = self.run_pm2ml(self.get_pm2ml_args() + package_names)
+        if pm2ml_queue == None:
+            return None
+
+        download_queue = []
+        for pkg, urls, sigs in pm2ml_queue.sync_pkgs:
+            download_queue.append({
+                'name': pkg.name,
+                'version': pkg.version,
+                'filename': pkg.filename,
+                'size': pkg.size,
+                'md5sum': pkg.md5sum,
+                'sha256sum': pkg.sha256sum,
+                'urls': list(urls) })
+        return download_queue
+
+    def resolve_with_alpm(self, package_names):
+        ''' Resolves package_names with a libalpm handle of our own (so it
+        doesn't interfere with anyone else's transactions). The handle is
+        created every time, as databases may have been downloaded again '''
+        try:
+            handle = self.pacman_conf.initialize_alpm()
+            index = pac.PackageIndex(handle.get_syncdbs(), self.conflicts)
+            pkgs = index.get_closure(package_names)
+        except Exception as e:
+            log.debug(_("Unable to create download queue: %s") % e)
+            return None
+
+        download_queue = []
+        for pkg in pkgs:
+            servers = self.pacman_conf.get_servers(pkg.db.name)
+            download_queue.append({
+                'name': pkg.name,
+                'version': pkg.version,
+                'filename': pkg.filename,
+                'size': pkg.size,
+                'md5sum': pkg.md5sum,
+                'sha256sum': pkg.sha256sum,
+                'urls': [ "%s/%s" % (server, pkg.filename) for server in servers ] })
+        return download_queue
+
+    def create_databases_metalink(self):
+        if self.pacman_conf != None:
+            metalink = self.create_databases_metalink_from_conf()
+        else:
+            metalink = self.create_databases_metalink_with_pm2ml()
+
+        # New databases, old resolutions are no longer valid
+        if metalink != None and self.resolution_cache != None:
+            self.resolution_cache.invalidate()
+
         return metalink
 
-    def add_metalink(self, s, metalink):
+    def create_databases_metalink_with_pm2ml(self):
+        pargs, pm2ml_queue = self.run_pm2ml(self.get_pm2ml_args() + ["-y"])
+        if pm2ml_queue == None:
+            return None
+
+        return pm2ml.download_queue_to_metalink(
+            pm2ml_queue,
+            output_dir=pargs.output_dir,
+            set_preference=pargs.preference)
+
+    def create_databases_metalink_from_conf(self):
+        ''' The servers of every repo come from our parsed pacman.conf '''
+        download_queue = []
+        for repo in self.pacman_conf.repos:
+            filename = "%s.db" % repo
+            download_queue.append({
+                'filename': filename,
+                'size': None,
+                'md5sum': None,
+                'sha256sum': None,
+                'urls': [ "%s/%s" % (server, filename) for server in self.pacman_conf.get_servers(repo) ] })
+        if len(download_queue) == 0:
+            return None
+        return download_queue_to_metalink(download_queue)
+
+    def get_download_queue(self, package_names):
+        ''' Returns the files we need to download to install package_names,
+        sorted following the order of package_names '''
+        download_queue = self.resolve(package_names)
+        if download_queue == None:
+            return None
+
+        for item in download_queue:
+            self.items[item['filename']] = item
+
+        download_queue = package_cache.seed_download_queue(download_queue, \
+            self.cache_dir, self.local_cache_dirs, self.on_local_file)
+
+        sort_download_queue(download_queue, package_names)
+
+        return download_queue
+
+    def on_local_file(self, path):
+        ''' Called for every file we already have (it has been checked
+        against the sync db, so it doesn't need to be verified again) '''
+        item = self.items.get(os.path.basename(path))
+        if self.verifier != None and item != None:
+            self.verifier.add_verified(path, item)
+        elif self.file_callback != None:
+            self.file_callback(path)
+
+    def restore_session(self):
+        ''' Gets the unfinished downloads that aria2 has loaded from the
+        session file of a previous run '''
+        self.restored = {}
+        if self.server == None or not self.session_restored:
+            return
+
+        keys = [ 'gid', 'files' ]
+        try:
+            downloads = self.server.aria2.tellActive(keys)
+            downloads += self.server.aria2.tellWaiting(0, 10000, keys)
+        except (xmlrpc.client.Fault, ConnectionRefusedError, BrokenPipeError) as e:
+            log.debug(_("Can't get restored downloads from aria2: %s") % e)
+            return
+
+        for r in downloads:
+            if len(r['files']) > 0:
+                filename = os.path.basename(r['files'][0]['path'])
+                self.restored[filename] = r['gid']
+
+        if len(self.restored) > 0:
+            log.debug(_("Resuming %d downloads from a previous session") % len(self.restored))
+
+    def adopt_restored_downloads(self, download_queue):
+        ''' Splits download_queue in the files that we still have to add
+        to aria2 and the gids of the ones restored from the last session '''
+        to_download = []
+        gids = []
+        for item in download_queue:
+            gid = self.restored.pop(item['filename'], None)
+            if gid == None:
+                to_download.append(item)
+            else:
+                gids.append(gid)
+        return to_download, gids
+
+    def forget_restored_downloads(self, filter_func=None):
+        ''' Removes restored downloads that we don't need anymore
+        (for instance, the package selection has changed). If filter_func
+        is given, only the files for which it returns True are removed '''
+        for filename in list(self.restored.keys()):
+            if filter_func != None and not filter_func(filename):
+                continue
+            gid = self.restored.pop(filename)
+            try:
+                self.server.aria2.remove(gid)
+            except (xmlrpc.client.Fault, ConnectionRefusedError, BrokenPipeError):
+                pass
+
+    def remove_session(self):
+        ''' Everything has been downloaded, there's nothing to resume '''
+        try:
+            self.server.aria2.purgeDownloadResult()
+            self.server.aria2.saveSession()
+        except (xmlrpc.client.Fault, ConnectionRefusedError, BrokenPipeError):
+            pass
+        if os.path.exists(self.session_file):
+            os.remove(self.session_file)
+
+    def add_metalink(self, s, metalink, options=None):
         gids = []
+        if options == None:
+            options = {}
         if metalink != None:
             try:
                 binary_metalink = xmlrpc.client.Binary(str(metalink).encode())
-                gids = s.aria2.addMetalink(binary_metalink)
+                gids = s.aria2.addMetalink(binary_metalink, options)
             except (xmlrpc.client.Fault, ConnectionRefusedError, BrokenPipeError) as e:
                 print("Can't communicate with Aria2. Won't be able to speed up the download:")
                 print(e)
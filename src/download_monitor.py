@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  download_monitor.py
+#
+#  Copyright 2013 Antergos
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#  Antergos Team:
+#   Alex Filgueira (faidoc) <alexfilgueira.antergos.com>
+#   Raúl Granados (pollitux) <raulgranados.antergos.com>
+#   Gustau Castells (karasu) <karasu.antergos.com>
+#   Kirill Omelchenko (omelcheck) <omelchek.antergos.com>
+#   Marc Miralles (arcnexus) <arcnexus.antergos.com>
+#   Alex Skinner (skinner) <skinner.antergos.com>
+
+''' Watches a set of aria2 downloads without flooding the aria2 daemon.
+
+aria2 pushes onDownloadComplete/onDownloadError notifications through its
+WebSocket RPC interface. When the websocket module (python-websocket-client)
+is available we listen to them in a thread, and we only ask aria2 for the
+active downloads once per tick. Without it, all tracked gids are queried
+with a single system.multicall per tick. '''
+
+import os
+import json
+import time
+import threading
+import xmlrpc.client
+import urllib.parse
+
+import log
+
+try:
+    import websocket
+    _websocket_available = True
+except ImportError:
+    _websocket_available = False
+
+# Status fields we need from aria2
+_status_keys = ['gid', 'status', 'totalLength', 'completedLength',
+                'downloadSpeed', 'files']
+
+# When listening to notifications, query all gids once every these ticks
+_reconcile_ticks = 20
+
+def get_used_host(aria2_file):
+    ''' Returns the host aria2 is downloading a file from '''
+    for uri in aria2_file.get('uris', []):
+        if uri['status'] == "used":
+            return urllib.parse.urlsplit(uri['uri']).netloc
+    return None
+
+class NotificationListener(threading.Thread):
+    ''' Collects aria2 download notifications sent through the websocket '''
+    def __init__(self, url):
+        super(NotificationListener, self).__init__()
+        self.daemon = True
+        self.url = url
+        self.ws = None
+        self.running = False
+        self.lock = threading.Lock()
+        self.completed = set()
+        self.failed = set()
+
+    def connect(self):
+        try:
+            self.ws = websocket.create_connection(self.url, timeout=1)
+        except (websocket.WebSocketException, OSError) as e:
+            log.debug(_("Can't listen to aria2 notifications: %s") % e)
+            self.ws = None
+            return False
+        self.running = True
+        return True
+
+    def run(self):
+        while self.running:
+            try:
+                message = self.ws.recv()
+            except websocket.WebSocketTimeoutException:
+                continue
+            except (websocket.WebSocketException, OSError):
+                break
+
+            try:
+                notification = json.loads(message)
+                method = notification['method']
+                gids = [ param['gid'] for param in notification['params'] ]
+            except (ValueError, KeyError, TypeError):
+                continue
+
+            with self.lock:
+                if method == "aria2.onDownloadComplete" or \
+                   method == "aria2.onBtDownloadComplete":
+                    self.completed.update(gids)
+                elif method == "aria2.onDownloadError":
+                    self.failed.update(gids)
+
+        self.running = False
+
+    def stop(self):
+        self.running = False
+        if self.ws != None:
+            try:
+                self.ws.close()
+            except (websocket.WebSocketException, OSError):
+                pass
+
+    def pop_finished(self):
+        with self.lock:
+            completed = self.completed
+            failed = self.failed
+            self.completed = set()
+            self.failed = set()
+        return completed, failed
+
+class DownloadMonitor(object):
+    ''' Tracks all gids at once and calls callback once per tick with
+    the aggregated progress of the whole set '''
+    def __init__(self, server, gids, ws_url=None, interval=0.5, callback=None):
+        self.server = server
+        self.interval = interval
+        self.callback = callback
+
+        self.pending = list(gids)
+        self.lengths = {}
+        self.paths = {}
+        self.hosts = {}
+        self.completed = []
+        self.failed = []
+        self.ticks = 0
+
+        self.listener = None
+        if ws_url != None and _websocket_available:
+            listener = NotificationListener(ws_url)
+            if listener.connect():
+                listener.start()
+                self.listener = listener
+
+    def add_gids(self, gids):
+        ''' Starts tracking more gids (for instance, files that are being
+        downloaded again) '''
+        self.pending += [ gid for gid in gids if gid not in self.pending ]
+
+    def multicall_status(self, gids):
+        ''' Returns the status of all gids using one system.multicall '''
+        multicall = xmlrpc.client.MultiCall(self.server)
+        for gid in gids:
+            multicall.aria2.tellStatus(gid, _status_keys)
+
+        status = {}
+        results = multicall()
+        for i in range(len(gids)):
+            try:
+                status[gids[i]] = results[i]
+            except xmlrpc.client.Fault as e:
+                # aria2 forgot about this gid
+                log.debug(e)
+                status[gids[i]] = { 'status': 'removed' }
+        return status
+
+    def get_status(self):
+        self.ticks += 1
+        # Every now and then query all gids, just in case we have missed
+        # a notification (for instance, one sent before we connected)
+        reconcile = (self.ticks % _reconcile_ticks == 0)
+        if self.listener != None and self.listener.running and not reconcile:
+            completed, failed = self.listener.pop_finished()
+            status = {}
+            for gid in completed:
+                status[gid] = { 'status': 'complete' }
+            for gid in failed:
+                status[gid] = { 'status': 'error' }
+            for r in self.server.aria2.tellActive(_status_keys):
+                status[r['gid']] = r
+            # gids we still don't know the size of
+            unknown = [ gid for gid in self.pending
+                        if gid not in self.lengths and gid not in status ]
+            if len(unknown) > 0:
+                status.update(self.multicall_status(unknown))
+            return status
+        else:
+            return self.multicall_status(self.pending)
+
+    def tick(self):
+        try:
+            status = self.get_status()
+        except (xmlrpc.client.Fault, ConnectionRefusedError, BrokenPipeError) as e:
+            log.debug(_("Can't get download status from aria2: %s") % e)
+            status = {}
+
+        progress = {}
+        active = {}
+        speed = 0
+        finished = []
+        downloads = {}
+
+        for gid in self.pending:
+            if gid not in status:
+                continue
+            r = status[gid]
+
+            total = int(r.get('totalLength', 0))
+            if total == 0 and len(r.get('files', [])) > 0:
+                total = int(r['files'][0]['length'])
+            if total > 0:
+                self.lengths[gid] = total
+            if len(r.get('files', [])) > 0:
+                self.paths[gid] = r['files'][0]['path']
+                host = get_used_host(r['files'][0])
+                if host != None:
+                    self.hosts[gid] = host
+
+            if r['status'] == "complete":
+                self.completed.append(gid)
+                finished.append(gid)
+                downloads[gid] = self.get_download_info(gid, self.lengths.get(gid, 0), r['status'])
+            elif r['status'] in [ "error", "removed" ]:
+                self.failed.append(gid)
+                finished.append(gid)
+                downloads[gid] = self.get_download_info(gid, None, r['status'])
+            else:
+                progress[gid] = int(r.get('completedLength', 0))
+                downloads[gid] = self.get_download_info(gid, progress[gid], r['status'])
+                speed += int(r.get('downloadSpeed', 0))
+                if r['status'] == "active" and len(r.get('files', [])) > 0:
+                    active[gid] = os.path.basename(r['files'][0]['path'])
+
+        if len(finished) > 0:
+            self.pending = [ gid for gid in self.pending if gid not in finished ]
+            # Gids that finished between ticks (notified through the
+            # websocket) may have never been seen active
+            self.get_missing_paths(finished)
+            self.remove_results(finished)
+            for gid in finished:
+                downloads[gid]['path'] = self.paths.get(gid)
+                downloads[gid]['host'] = self.hosts.get(gid)
+                if downloads[gid]['completed_length'] != None:
+                    downloads[gid]['total_length'] = self.lengths.get(gid, 0)
+                    downloads[gid]['completed_length'] = self.lengths.get(gid, 0)
+
+        total = sum(self.lengths.values())
+        completed = sum(progress.values())
+        for gid in self.completed:
+            completed += self.lengths.get(gid, 0)
+
+        return {
+            'total_length': total,
+            'completed_length': completed,
+            'download_speed': speed,
+            'active': active,
+            'pending': len(self.pending),
+            'completed': list(self.completed),
+            'failed': list(self.failed),
+            'finished': finished,
+            'downloads': downloads,
+            'completed_files': [ self.paths[gid] for gid in finished
+                                 if gid in self.paths and gid in self.completed ] }
+
+    def get_missing_paths(self, gids):
+        ''' Asks aria2 for the files of the gids we don't know the path of
+        (must be done before their results are removed) '''
+        missing = [ gid for gid in gids if gid not in self.paths ]
+        if len(missing) == 0:
+            return
+
+        multicall = xmlrpc.client.MultiCall(self.server)
+        for gid in missing:
+            multicall.aria2.tellStatus(gid, ['totalLength', 'files'])
+        try:
+            results = multicall()
+            for i in range(len(missing)):
+                try:
+                    files = results[i].get('files', [])
+                except xmlrpc.client.Fault as e:
+                    log.debug(e)
+                    continue
+                total = int(results[i].get('totalLength', 0))
+                if total > 0:
+                    self.lengths[missing[i]] = total
+                if len(files) > 0:
+                    self.paths[missing[i]] = files[0]['path']
+                    host = get_used_host(files[0])
+                    if host != None:
+                        self.hosts[missing[i]] = host
+        except (xmlrpc.client.Fault, ConnectionRefusedError, BrokenPipeError) as e:
+            log.debug(_("Can't get download status from aria2: %s") % e)
+
+    def get_download_info(self, gid, completed_length, status):
+        return {
+            'path': self.paths.get(gid),
+            'host': self.hosts.get(gid),
+            'total_length': self.lengths.get(gid, 0),
+            'completed_length': completed_length,
+            'status': status }
+
+    def remove_results(self, gids):
+        multicall = xmlrpc.client.MultiCall(self.server)
+        for gid in gids:
+            multicall.aria2.removeDownloadResult(gid)
+        try:
+            for result in multicall():
+                pass
+        except (xmlrpc.client.Fault, ConnectionRefusedError, BrokenPipeError):
+            pass
+
+    def run(self):
+        ''' Blocks until all gids are finished '''
+        try:
+            while len(self.pending) > 0:
+                progress = self.tick()
+                if self.callback != None:
+                    self.callback(progress)
+                if len(self.pending) > 0:
+                    time.sleep(self.interval)
+        finally:
+            if self.listener != None:
+                self.listener.stop()
+        return self.completed, self.failed
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  download_telemetry.py
+#
+#  Copyright 2013 Antergos
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#  Antergos Team:
+#   Alex Filgueira (faidoc) <alexfilgueira.antergos.com>
+#   Raúl Granados (pollitux) <raulgranados.antergos.com>
+#   Gustau Castells (karasu) <karasu.antergos.com>
+#   Kirill Omelchenko (omelcheck) <omelchek.antergos.com>
+#   Marc Miralles (arcnexus) <arcnexus.antergos.com>
+#   Alex Skinner (skinner) <skinner.antergos.com>
+
+''' Download statistics: bytes and time per package and per mirror, and an
+aggregate rate (moving average) with the estimated time left '''
+
+import json
+import time
+import urllib.parse
+
+import log
+
+# Weight of the newest sample in the moving average of the download rate
+_alpha = 0.3
+
+# Where the summary of the download phase is written
+_summary_file = "/tmp/cnchi-downloads.json"
+
+def get_host(url):
+    return urllib.parse.urlsplit(url).netloc
+
+class DownloadTelemetry(object):
+    def __init__(self, total_length=0):
+        self.start_time = time.time()
+        self.end_time = None
+
+        self.total_length = total_length
+        self.completed_length = 0
+
+        self.packages = {}
+        self.mirrors = {}
+
+        self.rate = 0.0
+        self.last_sample_time = self.start_time
+        self.last_sample_length = 0
+
+    def add_total_length(self, length):
+        self.total_length += length
+
+    def start_package(self, filename, size):
+        if filename not in self.packages:
+            self.packages[filename] = {
+                'size': size,
+                'bytes': 0,
+                'start': time.time(),
+                'end': None,
+                'ok': None,
+                'mirrors': [] }
+
+    def get_mirror(self, host):
+        if host not in self.mirrors:
+            now = time.time()
+            self.mirrors[host] = {
+                'bytes': 0, 'files': 0, 'failures': 0, 'first': now, 'last': now }
+        return self.mirrors[host]
+
+    def add_bytes(self, filename, host, length):
+        ''' Accounts length bytes of filename downloaded from host
+        (length can be negative if some data has been discarded) '''
+        package = self.packages.get(filename)
+        if package != None:
+            package['bytes'] += length
+            if host not in package['mirrors']:
+                package['mirrors'].append(host)
+
+        mirror = self.get_mirror(host)
+        mirror['bytes'] += length
+        mirror['last'] = time.time()
+
+        self.completed_length += length
+
+    def end_package(self, filename, ok):
+        package = self.packages.get(filename)
+        if package == None or package['end'] != None:
+            return
+        package['end'] = time.time()
+        package['ok'] = ok
+
+        for host in package['mirrors']:
+            mirror = self.mirrors[host]
+            if ok:
+                mirror['files'] += 1
+            else:
+                mirror['failures'] += 1
+
+    def add_failure(self, host):
+        mirror = self.get_mirror(host)
+        mirror['failures'] += 1
+
+    def sample(self):
+        ''' Updates the moving average of the download rate. Must be called
+        periodically (each download monitor tick, for instance) '''
+        now = time.time()
+        elapsed = now - self.last_sample_time
+        if elapsed <= 0:
+            return
+        instant_rate = (self.completed_length - self.last_sample_length) / elapsed
+        if self.rate == 0:
+            self.rate = instant_rate
+        else:
+            self.rate = _alpha * instant_rate + (1 - _alpha) * self.rate
+        self.last_sample_time = now
+        self.last_sample_length = self.completed_length
+
+    def get_eta(self):
+        ''' Seconds left to download the remaining bytes (None if unknown) '''
+        if self.rate <= 0:
+            return None
+        remaining = max(self.total_length - self.completed_length, 0)
+        return remaining / self.rate
+
+    def get_mirror_rate(self, host):
+        mirror = self.mirrors[host]
+        elapsed = mirror['last'] - mirror['first']
+        if elapsed <= 0:
+            return 0.0
+        return mirror['bytes'] / elapsed
+
+    def get_stats(self):
+        ''' Returns the current statistics (to be sent as an event) '''
+        mirrors = {}
+        for host in self.mirrors:
+            mirrors[host] = int(self.get_mirror_rate(host))
+        eta = self.get_eta()
+        if eta != None:
+            eta = int(eta)
+        return {
+            'rate': int(self.rate),
+            'eta': eta,
+            'completed_length': self.completed_length,
+            'total_length': self.total_length,
+            'mirrors': mirrors }
+
+    def finish(self):
+        self.end_time = time.time()
+
+    def get_summary(self):
+        end_time = self.end_time or time.time()
+        elapsed = end_time - self.start_time
+
+        packages = {}
+        for filename, package in self.packages.items():
+            seconds = None
+            if package['end'] != None:
+                seconds = round(package['end'] - package['start'], 3)
+            packages[filename] = {
+                'size': package['size'],
+                'bytes': package['bytes'],
+                'seconds': seconds,
+                'ok': package['ok'],
+                'mirrors': package['mirrors'] }
+
+        mirrors = {}
+        for host, mirror in self.mirrors.items():
+            mirrors[host] = {
+                'bytes': mirror['bytes'],
+                'rate': int(self.get_mirror_rate(host)),
+                'files': mirror['files'],
+                'failures': mirror['failures'] }
+
+        rate = 0
+        if elapsed > 0:
+            rate = int(self.completed_length / elapsed)
+
+        return {
+            'seconds': round(elapsed, 3),
+            'bytes': self.completed_length,
+            'rate': rate,
+            'packages': packages,
+            'mirrors': mirrors }
+
+    def write_summary(self, path=None):
+        if path == None:
+            path = _summary_file
+        try:
+            with open(path, "wt") as f:
+                json.dump(self.get_summary(), f, indent=2, sort_keys=True)
+        except (IOError, OSError) as e:
+            log.debug(_("Can't write download summary to %s: %s") % (path, e))
+
+def format_stats(stats):
+    ''' Returns a text like "1.2 MiB/s, 3 minutes left" '''
+    txt = "%.1f MiB/s" % (stats['rate'] / 1048576)
+    eta = stats['eta']
+    if eta != None:
+        if eta >= 120:
+            txt += ", " + _("%d minutes left") % (eta // 60)
+        else:
+            txt += ", " + _("%d seconds left") % eta
+    return txt
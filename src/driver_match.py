@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  driver_match.py
+#
+#  Copyright 2013 Antergos
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#  Antergos Team:
+#   Alex Filgueira (faidoc) <alexfilgueira.antergos.com>
+#   Raúl Granados (pollitux) <raulgranados.antergos.com>
+#   Gustau Castells (karasu) <karasu.antergos.com>
+#   Kirill Omelchenko (omelcheck) <omelchek.antergos.com>
+#   Marc Miralles (arcnexus) <arcnexus.antergos.com>
+#   Alex Skinner (skinner) <skinner.antergos.com>
+
+
+''' Finds the drivers our hardware needs by matching the modaliases of the
+devices in sysfs against the patterns in data/drivers.xml, without running
+any external program. '''
+
+import os
+import re
+import fnmatch
+import xml.etree.ElementTree as etree
+
+import log
+
+_buses = [ "pci", "usb" ]
+
+# Compiled drivers.xml files, by path
+_drivers = {}
+
+def read_file(path):
+    with open(path, "rt") as f:
+        return f.read().strip()
+
+def get_usb_modalias(device_dir):
+    ''' USB devices (not their interfaces) have no modalias file, but we
+    can build the beginning of it with their vendor and product ids '''
+    vendor = read_file(os.path.join(device_dir, "idVendor"))
+    product = read_file(os.path.join(device_dir, "idProduct"))
+    return "usb:v%sp%s" % (vendor.upper(), product.upper())
+
+def read_modaliases(sysfs_dir="/sys"):
+    ''' Returns the modaliases of all PCI and USB devices '''
+    modaliases = []
+    for bus in _buses:
+        devices_dir = os.path.join(sysfs_dir, "bus", bus, "devices")
+        try:
+            names = sorted(os.listdir(devices_dir))
+        except OSError:
+            continue
+        for name in names:
+            device_dir = os.path.join(devices_dir, name)
+            try:
+                modaliases.append(read_file(os.path.join(device_dir, "modalias")))
+                continue
+            except (IOError, OSError):
+                pass
+            if bus == "usb":
+                try:
+                    modaliases.append(get_usb_modalias(device_dir))
+                except (IOError, OSError):
+                    # Not a device (a hub port, for instance)
+                    pass
+    return modaliases
+
+def load_drivers(path):
+    ''' Returns a list of (driver, regex matching its modaliases), in the
+    order they appear in drivers.xml '''
+    key = (path, os.path.getmtime(path))
+    if key not in _drivers:
+        drivers = []
+        root = etree.parse(path).getroot()
+        for category in root:
+            for driver in category:
+                patterns = [ fnmatch.translate(modalias.text.strip())
+                             for modalias in driver.iter('modalias') ]
+                if len(patterns) > 0:
+                    drivers.append((driver.tag, re.compile("|".join(patterns))))
+        _drivers[key] = drivers
+    return _drivers[key]
+
+def find_drivers(drivers_xml, sysfs_dir="/sys"):
+    ''' Returns the names of the drivers (packages.xml sections) needed
+    by the devices found in sysfs_dir '''
+    try:
+        drivers = load_drivers(drivers_xml)
+    except (IOError, OSError, etree.ParseError) as e:
+        log.debug(_("Can't load driver list %s: %s") % (drivers_xml, e))
+        return []
+
+    modaliases = read_modaliases(sysfs_dir)
+    found = []
+    for driver, regex in drivers:
+        for modalias in modaliases:
+            if regex.match(modalias):
+                found.append(driver)
+                break
+    return found
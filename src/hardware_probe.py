@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  hardware_probe.py
+#
+#  Copyright 2013 Antergos
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#  Antergos Team:
+#   Alex Filgueira (faidoc) <alexfilgueira.antergos.com>
+#   Raúl Granados (pollitux) <raulgranados.antergos.com>
+#   Gustau Castells (karasu) <karasu.antergos.com>
+#   Kirill Omelchenko (omelcheck) <omelchek.antergos.com>
+#   Marc Miralles (arcnexus) <arcnexus.antergos.com>
+#   Alex Skinner (skinner) <skinner.antergos.com>
+
+
+''' Probes the hardware (the drivers it needs and the filesystems in our
+disks) in the background while the user goes through the installer pages,
+so the installation process doesn't have to wait for it.
+
+External probes are started at once when HardwareProbe is created (that has
+to be done before dropping privileges, as they need to be run as root). A
+thread collects their output and stores it in settings['hardware']:
+
+    { 'drivers': [ packages.xml sections ], 'filesystems': [ types ] }
+
+settings['hardware_probing'] is True while the thread is running, so other
+processes wait for its results instead of probing again.
+
+Drivers are found by driver_match, reading sysfs. '''
+
+import os
+import subprocess
+import threading
+import time
+
+import log
+import driver_match
+
+_probes = {
+    'filesystems': ["blkid", "-c", "/dev/null", "-o", "value", "-s", "TYPE"] }
+
+def parse_filesystems(output):
+    fs_types = set()
+    for line in output.splitlines():
+        if line.strip() != "":
+            fs_types.add(line.strip().lower())
+    return sorted(fs_types)
+
+_parsers = {
+    'filesystems': parse_filesystems }
+
+# How long we wait for a running background probe (seconds)
+_probe_timeout = 60
+
+def start_probes():
+    ''' Starts all probe commands (they run concurrently) '''
+    processes = {}
+    for name, cmd in _probes.items():
+        try:
+            processes[name] = subprocess.Popen(cmd, stdout=subprocess.PIPE, \
+                stderr=subprocess.DEVNULL)
+        except OSError as e:
+            log.debug(_("Can't run %s: %s") % (cmd[0], e))
+    return processes
+
+def collect_probes(processes, data_dir):
+    ''' Waits for the probes started by start_probes and parses their
+    output. Probes that couldn't be run report nothing found '''
+    hardware = { 'drivers': [], 'filesystems': [] }
+
+    drivers_xml = os.path.join(data_dir, "drivers.xml")
+    hardware['drivers'] = driver_match.find_drivers(drivers_xml)
+
+    for name, process in processes.items():
+        start = time.time()
+        out, err = process.communicate()
+        if process.returncode != 0:
+            log.debug(_("Hardware probe '%s' failed (exit code %d)") % (name, process.returncode))
+        hardware[name] = _parsers[name](out.decode(errors="replace"))
+        log.debug(_("Hardware probe '%s' finished (waited %.1f seconds)") % (name, time.time() - start))
+    return hardware
+
+def probe(data_dir):
+    ''' Runs all probes and waits for them '''
+    return collect_probes(start_probes(), data_dir)
+
+def get_hardware(settings):
+    ''' Returns the probe results. If the background probe is still
+    running, its results are waited for. Only if it hasn't been started
+    (or has failed) the hardware is probed now '''
+    hardware = settings.get("hardware")
+    start = time.time()
+    while hardware == None and settings.get("hardware_probing"):
+        if time.time() - start > _probe_timeout:
+            log.debug(_("The hardware probe is taking too long"))
+            break
+        time.sleep(0.2)
+        hardware = settings.get("hardware")
+    if hardware == None:
+        log.debug(_("Hardware has not been probed yet, probing it now"))
+        hardware = probe(settings.get("DATA_DIR"))
+        settings.set("hardware", hardware)
+    return hardware
+
+class HardwareProbe(threading.Thread):
+    ''' Starts all probes and stores their results in settings '''
+    def __init__(self, settings):
+        super(HardwareProbe, self).__init__()
+        self.daemon = True
+        self.settings = settings
+        self.settings.set("hardware_probing", True)
+        self.processes = start_probes()
+
+    def run(self):
+        try:
+            hardware = collect_probes(self.processes, self.settings.get("DATA_DIR"))
+            self.settings.set("hardware", hardware)
+        except OSError as e:
+            log.debug(_("Can't probe hardware: %s") % e)
+        finally:
+            self.settings.set("hardware_probing", False)
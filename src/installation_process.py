@@ -30,16 +30,27 @@
 
 from multiprocessing import Process
 import queue
+import threading
+import collections
 
 import subprocess
 import os
 import sys
 import time
 import shutil
+import json
 import xml.etree.ElementTree as etree
-from urllib.request import urlopen
 import crypt
 import download
+import async_download
+import package_decompress
+import local_repo
+import hardware_probe
+import package_closures
+import package_selection
+import package_list
+import resolution_cache
+import task_scheduler
 import config
 
 # Insert the src/pacman directory at the front of the path.
@@ -56,10 +67,32 @@ import fs_module as fs
 import misc
 
 import pac
+from pacman import pac_config
 
 _autopartition_script = 'auto_partition.sh'
 _postinstall_script = 'postinstall.sh'
 
+# In a pipelined install, don't commit stages smaller than this
+# (unless all downloads have finished)
+_min_stage_size = 20
+
+# Install stages already committed (relative to the target root). It lives
+# (and dies) with the packages it records: it only helps a retried install
+# that doesn't format the root partition again (advanced mode without
+# formatting /), automatic and alongside installs always start from scratch
+_install_stages_file = "var/lib/cnchi/install-stages.json"
+
+# Checkpoint key of the packages installed by download_and_install_packages,
+# as its stages are not the ones of packages.xml
+_pipelined_stage = "pipelined"
+
+# Mirror scores (see pacman/mirror_scores.py) are kept in TMP_DIR, so they
+# are used again by the next installation but never end in the target
+_mirror_scores_file = "cnchi-mirrors.json"
+
+# Max number of install tasks that can run at the same time
+_max_tasks = 4
+
 class InstallError(Exception):
     def __init__(self, value):
         self.value = value
@@ -111,6 +144,14 @@ class InstallationProcess(Process):
     def run(self):
         # Common vars
         self.packages = []
+        self.packages_xml_data = None
+        self.closure = None
+        # (stage name, index of its first package in self.packages)
+        self.install_stages = []
+
+        # Tasks using the sys, proc and dev mounts in the target
+        self.chroot_lock = threading.Lock()
+        self.chroot_users = 0
         
         self.dest_dir = "/install"
         if not os.path.exists(self.dest_dir):
@@ -121,6 +162,15 @@ class InstallationProcess(Process):
         self.initramfs = "initramfs-%s" % self.kernel_pkg       
 
         self.arch = os.uname()[-1]
+
+        # Nothing has been touched yet. If we can't install offline, it's
+        # the time to say it
+        if self.settings.get("offline"):
+            try:
+                self.check_offline_install()
+            except InstallError as e:
+                self.queue_fatal_event(e.value)
+                return False
         
         ## Create/Format partitions
         
@@ -214,47 +264,235 @@ class InstallationProcess(Process):
             self.queue_fatal_event(_("Can't create necessary directories on destination system"))
             return False
 
-        try:
-            self.queue_event('debug', 'Selecting packages...')
-            self.select_packages()
-            self.queue_event('debug', 'Packages selected')
-            
-            if self.settings.get("use_aria2"):
-                self.queue_event('debug', 'Downloading packages...')
-                self.download_packages()
-                self.queue_event('debug', 'Packages downloaded.')
-            
-            self.queue_event('debug', 'Installing packages...')
-            self.install_packages()
-            self.queue_event('debug', 'Packages installed.')
+        scheduler = task_scheduler.TaskScheduler(_max_tasks)
+        scheduler.add('select_packages', self.select_packages)
+        scheduler.add('packages', self.get_packages, [ 'select_packages' ])
+        self.add_configure_tasks(scheduler, [ 'packages' ])
+        # grub-mkconfig looks for the kernel and initramfs images in /boot,
+        # so they must have been written (by mkinitcpio) before
+        scheduler.add('bootloader', self.install_bootloader, [ 'packages', 'mkinitcpio' ])
 
-            self.queue_event('debug', 'Installing bootloader...')
-            self.install_bootloader()
-            self.queue_event('debug', 'Bootloader installed.')
-
-            self.queue_event('debug', 'Configuring system...')
-            self.configure_system()
-            self.queue_event('debug', 'System configured.')            
+        try:
+            scheduler.run()
         except subprocess.CalledProcessError as e:
             self.queue_fatal_event("CalledProcessError.output = %s" % e.output)
             return False
         except InstallError as e:
             self.queue_fatal_event(e.value)
             return False
+        finally:
+            self.queue_event('debug', scheduler.get_summary())
 
         # installation finished ok
         self.queue_event("finished")
         self.running = False
         return True
 
-    def download_packages(self):
+    def get_packages(self):
+        ''' Downloads (if needed) and installs the selected packages '''
+        if self.settings.get("use_aria2") and self.settings.get("pipelined_install"):
+            self.queue_event('debug', 'Downloading and installing packages...')
+            self.download_and_install_packages()
+            self.queue_event('debug', 'Packages downloaded and installed.')
+            return
+
+        if self.settings.get("use_aria2"):
+            self.queue_event('debug', 'Downloading packages...')
+            downloader = self.download_packages(run=False)
+            downloader.refresh_databases()
+            self.check_install_plan()
+            self.add_closure_to_downloader(downloader, self.packages)
+            downloader.download_packages(self.packages)
+            self.queue_event('debug', 'Packages downloaded.')
+        else:
+            self.check_install_plan()
+    
+        self.queue_event('debug', 'Installing packages...')
+        self.install_packages()
+        self.queue_event('debug', 'Packages installed.')
+
+    def download_packages(self, run=True, file_callback=None):
         conf_dir = "/tmp/pacman.conf"
         cache_dir = "%s/var/cache/pacman/pkg" % self.dest_dir
         databases_dir = "%s/var/lib/pacman/sync" % self.dest_dir
-        download.DownloadPackages(self.packages, conf_dir, cache_dir, databases_dir, self.callback_queue)
+        profiles_file = os.path.join(self.settings.get("DATA_DIR"), "powerpill.json")
+        local_cache_dirs = self.pacman_conf.options["CacheDir"]
+
+        downloader = download.DownloadPackages(self.packages, conf_dir, cache_dir, databases_dir, self.callback_queue, \
+            profile=self.settings.get("aria2_profile"), profiles_file=profiles_file, \
+            file_callback=file_callback, run=False, conflicts=self.conflicts, \
+            resolution_cache_dir="%s/var/cache/cnchi/resolution" % self.dest_dir, \
+            local_cache_dirs=local_cache_dirs, pacman_conf=self.pacman_conf)
+
+        if not downloader.is_available():
+            # Use our own downloader instead of aria2
+            self.queue_event('debug', "aria2 is not available, using the internal downloader")
+            downloader = async_download.DownloadPackages(self.pac, self.packages, cache_dir, \
+                self.callback_queue, file_callback=file_callback, run=False, \
+                conflicts=self.conflicts, local_cache_dirs=local_cache_dirs)
+
+        if run:
+            downloader.run(self.packages)
+
+        return downloader
+
+    def download_and_install_packages(self):
+        ''' Downloads packages in dependency order and installs them in
+        stages while the rest of them are still being downloaded '''
+        downloaded = queue.Queue()
+        downloader = self.download_packages(run=False, \
+            file_callback=lambda path: downloaded.put(os.path.basename(path)))
+        downloader.refresh_databases()
+        self.check_install_plan()
+
+        ordered, explicit = self.pac.get_install_order(self.packages, self.conflicts)
+        # The downloader gets its whole queue now: if it had to resolve it
+        # in its thread, it would use our libalpm handle while we install
+        downloader.add_precomputed([ pkg.name for pkg in ordered ], self.pac.get_download_queue(ordered))
+        if len(ordered) == 0:
+            # Let libalpm do all the work
+            self.install_packages()
+            return
+
+        # Packages committed by an earlier try (see _install_stages_file)
+        checkpoint = self.load_install_checkpoint()
+        installed = set(checkpoint.get(_pipelined_stage, []))
+        to_install = [ pkg for pkg in ordered if pkg.name not in installed ]
+        if len(to_install) < len(ordered):
+            self.queue_event('debug', "%d packages are already installed" % (len(ordered) - len(to_install)))
+
+        if len(to_install) > 0:
+            download_thread = threading.Thread(target=downloader.download_packages, \
+                args=([ pkg.name for pkg in ordered ],))
+            download_thread.start()
+
+            try:
+                self.install_downloaded_stages(to_install, downloaded, download_thread, checkpoint)
+            finally:
+                # Don't leave the downloader writing to the target if we have
+                # failed (it can't be stopped, so we wait for it)
+                download_thread.join()
+
+        # We have asked for the whole dependency closure, restore the
+        # install reason of the packages nobody asked for explicitly
+        explicit = set(explicit)
+        self.pac.mark_as_dependencies([ pkg.name for pkg in ordered if pkg.name not in explicit ])
+
+    def install_downloaded_stages(self, ordered, downloaded, download_thread, checkpoint):
+        ''' Installs ordered (packages in dependency order) in stages, as
+        their files arrive through the downloaded queue. Committed packages
+        are recorded in checkpoint '''
+        self.chroot_mount()
+        try:
+            ready = set()
+            remaining = list(ordered)
+            while len(remaining) > 0:
+                downloading = download_thread.is_alive()
+
+                try:
+                    while True:
+                        ready.add(downloaded.get_nowait())
+                except queue.Empty:
+                    pass
+
+                # As packages are sorted in dependency order, all dependencies
+                # of a fully downloaded prefix are in that prefix or already
+                # installed
+                stage = []
+                if downloading:
+                    for pkg in remaining:
+                        if pkg.filename not in ready:
+                            break
+                        stage.append(pkg)
+                    if len(stage) < _min_stage_size:
+                        time.sleep(1)
+                        continue
+                else:
+                    # Download has finished (libalpm will fetch anything left)
+                    stage = remaining
+
+                remaining = remaining[len(stage):]
+                self.queue_event('debug', "Installing a stage of %d packages (%d left)" % (len(stage), len(remaining)))
+                if not self.pac.install_packages([ pkg.name for pkg in stage ], self.conflicts):
+                    raise InstallError(_("Can't install the packages of a stage (%d packages)") % len(stage))
+
+                names = checkpoint.setdefault(_pipelined_stage, [])
+                names.extend(pkg.name for pkg in stage)
+                self.save_install_checkpoint(checkpoint)
+        finally:
+            self.chroot_umount()
+
+    def load_package_closure(self):
+        ''' Looks for a closure of our package list (or of most of it) in
+        packages.xml. It can only be used if it was made with our sync dbs,
+        so this must be called once they have been refreshed '''
+        self.closure = None
+        if self.packages_xml_data == None or b"<closures" not in self.packages_xml_data:
+            return
+
+        sync_dir = os.path.join(self.pacman_conf.options["DBPath"], "sync")
+        snapshot = resolution_cache.hash_databases(sync_dir)
+        closure = package_closures.find_closure(etree.fromstring(self.packages_xml_data), snapshot, \
+            self.packages, self.conflicts)
+        if closure == None:
+            self.queue_event('debug', "No precomputed closure for this package list")
+            return
+
+        self.queue_event('debug', "Using the precomputed closure (%d packages, %d more to resolve)" % \
+            (len(closure['packages']), len(closure['remainder'])))
+        self.pac.add_precomputed(closure['input'], closure['conflicts'], closure)
+        self.closure = closure
+
+    def add_closure_to_downloader(self, downloader, package_names):
+        if self.closure == None:
+            return
+        # packages.xml may come from anywhere: only the package names of the
+        # closure are used, filenames and checksums come from our sync dbs
+        # (see Pac.get_precomputed)
+        pkgs, explicit = self.pac.get_install_order(self.packages, self.conflicts)
+        if len(pkgs) == 0:
+            return
+        downloader.add_precomputed(package_names, self.pac.get_download_queue(pkgs))
+
+    def check_install_plan(self):
+        ''' Resolves the package list before downloading anything and
+        stops the installation if there isn't enough space for it '''
+        # Databases are fresh now
+        self.load_package_closure()
+
+        extra = []
+        if self.settings.get("predecompress"):
+            # The decompressed packages of a stage (about as big as their
+            # installed size) are kept until the stage is installed
+            stages = [ pkgs for name, pkgs in self.get_install_stages() ]
+            stage_sizes = self.pac.get_stage_sizes(stages, self.conflicts)
+            if len(stage_sizes) > 0:
+                extra.append((self.get_decompressed_dir(), max(stage_sizes)))
+
+        plan = self.pac.plan(self.packages, self.conflicts, extra)
+
+        txt = "%d packages to install (download: %s, installed: %s)" % \
+            (len(plan['packages']), self.pac.format_size(plan['download_size']), \
+             self.pac.format_size(plan['installed_size']))
+        self.queue_event('debug', txt)
+        if len(plan['to_remove']) > 0:
+            self.queue_event('debug', "Conflicting packages to remove: %s" % " ".join(plan['to_remove']))
+
+        for mount_point, space in plan['space'].items():
+            if space['needed'] > space['free']:
+                txt = _("Not enough space in %s: %s needed, %s available") % \
+                    (mount_point, self.pac.format_size(space['needed']), self.pac.format_size(space['free']))
+                raise InstallError(txt)
+
+        return plan
 
     # creates temporary pacman.conf file
     def create_pacman_conf(self):
+        if self.settings.get("offline"):
+            self.create_offline_pacman_conf()
+            self.init_pac()
+            return
+
         self.queue_event('debug', "Creating pacman.conf for %s architecture" % self.arch)
         
         # Common repos
@@ -293,10 +531,85 @@ class InstallationProcess(Process):
             tmp_file.write("Include = /etc/pacman.d/antergos-mirrorlist\n\n")
             tmp_file.write("#### Antergos repos end here\n\n")
         
+        self.init_pac()
+
+    def get_local_repo_dir(self):
+        # Outside the target, so nothing is left in the installed system
+        return os.path.join(self.settings.get("TMP_DIR"), "cnchi-local-repo")
+
+    def create_local_repo(self):
+        repo_dir = self.get_local_repo_dir()
+        local_dirs = self.settings.get("local_repo_dirs")
+
+        self.queue_event('info', _("Creating local repository..."))
+        try:
+            count = local_repo.create_local_repo(local_dirs, repo_dir)
+        except (subprocess.CalledProcessError, OSError) as e:
+            raise InstallError(_("Can't create the local repository: %s") % e)
+        if count == 0:
+            raise InstallError(_("No packages found in %s") % ", ".join(local_dirs))
+        self.queue_event('debug', "Local repository with %d packages" % count)
+
+    def write_offline_pacman_conf(self, path, root_dir=None):
+        ''' Writes a pacman.conf that only uses the local repo. root_dir
+        replaces the target as RootDir (and DBPath) if given '''
+        repo_dir = self.get_local_repo_dir()
+        if root_dir == None:
+            root_dir = self.dest_dir
+
+        with open(path, "wt") as tmp_file:
+            tmp_file.write("[options]\n")
+            if root_dir != self.dest_dir:
+                tmp_file.write("RootDir = %s\n" % root_dir)
+                tmp_file.write("DBPath = %s/var/lib/pacman\n" % root_dir)
+            tmp_file.write("Architecture = auto\n")
+            tmp_file.write("SigLevel = PackageOptional\n")
+            tmp_file.write("CacheDir = %s/var/cache/pacman/pkg\n" % root_dir)
+            # libalpm finds the packages here, so nothing is copied
+            tmp_file.write("CacheDir = %s\n\n" % repo_dir)
+            tmp_file.write("[%s]\n" % local_repo.repo_name)
+            tmp_file.write("SigLevel = Optional TrustAll\n")
+            tmp_file.write("Server = file://%s\n" % repo_dir)
+
+    def create_offline_pacman_conf(self):
+        ''' Creates a pacman.conf that only uses a local repo made with the
+        packages found in the live medium (or in the dirs given) '''
+        self.create_local_repo()
+        self.write_offline_pacman_conf("/tmp/pacman.conf")
+
+    def check_offline_install(self):
+        ''' Checks that the local repo has the whole closure of the packages
+        we are going to install. Must be done before touching any disk, so
+        it uses its own pacman dirs (not the target) '''
+        self.create_local_repo()
+
+        check_dir = os.path.join(self.settings.get("TMP_DIR"), "cnchi-offline-check")
+        db_dir = os.path.join(check_dir, "var/lib/pacman")
+        if not os.path.exists(db_dir):
+            os.makedirs(db_dir)
+        conf_path = os.path.join(check_dir, "pacman.conf")
+        self.write_offline_pacman_conf(conf_path, check_dir)
+
+        try:
+            check_pac = pac.Pac(pac_config.PacmanConfig(conf_path).freeze(), self.callback_queue)
+        except:
+            raise InstallError("Can't initialize pyalpm.")
+        check_pac.do_refresh(parallel=True)
+
+        self.choose_packages()
+        missing = check_pac.find_missing(self.packages, self.conflicts)
+        if len(missing) > 0:
+            txt = _("These packages are not available offline: %s") % ", ".join(missing)
+            raise InstallError(txt)
+
+    def init_pac(self):
         ## Init pyalpm
 
         try:
-            self.pac = pac.Pac("/tmp/pacman.conf", self.callback_queue)
+            # Parse pacman.conf (and its mirrorlists) only once
+            self.pacman_conf = pac_config.PacmanConfig("/tmp/pacman.conf").freeze()
+            scores_path = os.path.join(self.settings.get("TMP_DIR"), _mirror_scores_file)
+            self.pac = pac.Pac(self.pacman_conf, self.callback_queue, scores_path)
         except:
             raise InstallError("Can't initialize pyalpm.")
         
@@ -327,188 +640,207 @@ class InstallationProcess(Process):
         # If we use aria2, it will update the databases
         # if not, we have to do it here
         if not self.settings.get("use_aria2"):
-            self.pac.do_refresh()
+            self.pac.do_refresh(parallel=True)
 
     # Prepare pacman and get package list from Internet
     def select_packages(self):
         self.create_pacman_conf()
         self.prepare_pacman()
-        
+        self.choose_packages()
+
+    def choose_packages(self):
+        ''' Fills self.packages (and the install stages, conflicts...)
+        from packages.xml, the hardware and the user choices '''
+        self.packages = []
+        self.install_stages = []
+        self.conflicts = []
+        self.card = []
+
+        local_packages_xml = os.path.join(self.settings.get("DATA_DIR"), 'packages.xml')
+
         if len(self.alternate_package_list) > 0:
-            packages_xml = self.alternate_package_list
+            with open(self.alternate_package_list, "rb") as f:
+                data = f.read()
+        elif self.settings.get("offline"):
+            with open(local_packages_xml, "rb") as f:
+                data = f.read()
         else:
             '''The list of packages is retrieved from an online XML to let us
-            control the pkgname in case of any modification'''
+            control the pkgname in case of any modification. If the server
+            can't give it to us in time, we use the copy we got last time or,
+            if there isn't one, a local file that may not be updated'''
             
             self.queue_event('info', "Getting package list...")
 
-            try:
-                packages_xml = urlopen('http://install.antergos.com/packages.xml')
-            except URLError as e:
-                # If the installer can't retrieve the remote file, try to install with a local
-                # copy, that may not be updated
-                self.queue_event('debug', _("Can't retrieve remote package list, using a local file instead."))
-                data_dir = self.settings.get("DATA_DIR")
-                packages_xml = os.path.join(data_dir, 'packages.xml')
-
-        tree = etree.parse(packages_xml)
-        root = tree.getroot()
-
-        self.queue_event('debug', "Adding base packages")
-
-        for child in root.iter('common_system'):
-            for pkg in child.iter('pkgname'):
-                self.packages.append(pkg.text)
-
-        self.queue_event('debug', "Adding desktop packages")
-
-        for child in root.iter(self.desktop + '_desktop'):
-            for pkg in child.iter('pkgname'):
-                # If package is Desktop Manager, save name to 
-                # activate the correct service
-                if pkg.attrib.get('dm'):
-                    self.desktop_manager = pkg.attrib.get('name')
-                if pkg.attrib.get('nm'):
-                    self.network_manager = pkg.attrib.get('name')
-                if pkg.attrib.get('conflicts'):
-                    self.conflicts.append(pkg.attrib.get('conflicts'))
-                self.packages.append(pkg.text)
-        
-        if self.settings.get("use_ntp"):
-            for child in root.iter('ntp'):
-                for pkg in child.iter('pkgname'):
-                    self.packages.append(pkg.text)
-
-        graphics = self.get_graphics_card()
-        
-
-        if "ati " in graphics:
-            for child in root.iter('ati'):
-                for pkg in child.iter('pkgname'):
-                    self.packages.append(pkg.text)
-            self.card.append('ati')
-        
-        if "nvidia" in graphics:
-            for child in root.iter('nvidia'):
-                for pkg in child.iter('pkgname'):
-                    self.packages.append(pkg.text)
-            self.card.append('nvidia')
-        
-        if "intel" in graphics or "lenovo" in graphics:
-            for child in root.iter('intel'):
-                for pkg in child.iter('pkgname'):
-                    self.packages.append(pkg.text)
-            self.card.append('intel')
-        
-        if "virtualbox" in graphics:
-            for child in root.iter('virtualbox'):
-                for pkg in child.iter('pkgname'):
-                    self.packages.append(pkg.text)
-        
-        if "vmware" in graphics:
-            for child in root.iter('vmware'):
-                for pkg in child.iter('pkgname'):
-                    self.packages.append(pkg.text)
-        
-        if "via " in graphics:
-            for child in root.iter('via'):
-                for pkg in child.iter('pkgname'):
-                    self.packages.append(pkg.text)
-        
-        wlan = subprocess.check_output(\
-            ["hwinfo", "--wlan", "--short"]).decode()
-
-        if "broadcom" in wlan:
-            for child in root.iter('broadcom'):
-                for pkg in child.iter('pkgname'):
-                    self.packages.append(pkg.text)
-        
-        # Add filesystem packages
-        
-        self.queue_event('debug', "Adding filesystem packages")       
-        
-        fs_types = subprocess.check_output(\
-            ["blkid", "-c", "/dev/null", "-o", "value", "-s", "TYPE"]).decode()
-
-        if "ntfs" in fs_types:
-            for child in root.iter('ntfs'):
-                for pkg in child.iter('pkgname'):
-                    self.packages.append(pkg.text)
-        
-        if "btrfs" in fs_types:
-            for child in root.iter('btrfs'):
-                for pkg in child.iter('pkgname'):
-                    self.packages.append(pkg.text)
-
-        if "nilfs2" in fs_types:
-            for child in root.iter('nilfs2'):
-                for pkg in child.iter('pkgname'):
-                    self.packages.append(pkg.text)
-
-        if "ext" in fs_types:
-            for child in root.iter('ext'):
-                for pkg in child.iter('pkgname'):
-                    self.packages.append(pkg.text)
-
-        if "reiserfs" in fs_types:
-            for child in root.iter('reiserfs'):
-                for pkg in child.iter('pkgname'):
-                    self.packages.append(pkg.text)
-
-        if "xfs" in fs_types:
-            for child in root.iter('xfs'):
-                for pkg in child.iter('pkgname'):
-                    self.packages.append(pkg.text)
-
-        if "jfs" in fs_types:
-            for child in root.iter('jfs'):
-                for pkg in child.iter('pkgname'):
-                    self.packages.append(pkg.text)
-
-        if "vfat" in fs_types:
-            for child in root.iter('vfat'):
-                for pkg in child.iter('pkgname'):
-                    self.packages.append(pkg.text)
-
-        
-        # Third-party software
-        if self.settings.get("third_party_software") is True:
-            self.queue_event('debug', 'Selecting third-party software.')
-            for child in root.iter('third_party'):
-                for pkg in child.iter('pkgname'):
-                    self.packages.append(pkg.text)
-
-        # Install chinese fonts
+            data = package_list.get_package_list(self.settings.get("TMP_DIR"), local_packages_xml)
+
+        # Used later, to look for a precomputed closure
+        self.packages_xml_data = data
+
+        cache_file = os.path.join(self.settings.get("TMP_DIR"), "cnchi-packages-index.json")
+        index = package_selection.load_index(data, cache_file)
+
+        hardware = hardware_probe.get_hardware(self.settings)
+
+        # Filesystems found when the installer started plus the ones
+        # we have just created
+        fs_types = hardware['filesystems'] + list(self.fs_devices.values())
+
         lang_code = self.settings.get("language_code")
-        if lang_code == "zh_TW" or lang_code == "zh_CN":
-            self.queue_event('debug', 'Selecting chinese fonts.')
-            for child in root.iter('chinese'):
-                for pkg in child.iter('pkgname'):
-                    self.packages.append(pkg.text)
-
-        # Lets start from a basic install, installing grub2 (bios) by default
-        for child in root.iter('grub'):
-            for pkg in child.iter('pkgname'):
-                self.packages.append(pkg.text)
-
-    def get_graphics_card(self):
-        p1 = subprocess.Popen(["hwinfo", "--gfxcard"], \
-                              stdout=subprocess.PIPE)
-        p2 = subprocess.Popen(["grep", "Model:[[:space:]]"],\
-                              stdin=p1.stdout, stdout=subprocess.PIPE)
-        p1.stdout.close()
-        out, err = p2.communicate()
-        return out.decode().lower()
-    
+
+        facts = {
+            'desktop': self.desktop,
+            'use_ntp': self.settings.get("use_ntp"),
+            'drivers': hardware['drivers'],
+            'filesystems': package_selection.get_filesystem_sections(index, fs_types),
+            'third_party_software': self.settings.get("third_party_software") is True,
+            'chinese_fonts': lang_code == "zh_TW" or lang_code == "zh_CN" }
+
+        stage = None
+        for pkg_stage, pkgname, attributes in package_selection.select(index, facts):
+            if pkg_stage != stage:
+                self.queue_event('debug', "Adding %s packages" % pkg_stage)
+                self.begin_install_stage(pkg_stage)
+                stage = pkg_stage
+            # If package is Desktop Manager, save name to 
+            # activate the correct service
+            if attributes.get('dm'):
+                self.desktop_manager = attributes.get('name')
+            if attributes.get('nm'):
+                self.network_manager = attributes.get('name')
+            if attributes.get('conflicts'):
+                self.conflicts.append(attributes.get('conflicts'))
+            self.packages.append(pkgname)
+
+        for driver in hardware['drivers']:
+            if driver in [ 'ati', 'nvidia', 'intel' ]:
+                self.card.append(driver)
+
+    def begin_install_stage(self, name):
+        ''' Packages added to self.packages from now on belong to stage name '''
+        self.install_stages.append((name, len(self.packages)))
+
+    def get_install_stages(self):
+        ''' Returns a list of (stage name, packages), in install order '''
+        if len(self.install_stages) == 0:
+            return [ ('all', list(self.packages)) ]
+
+        stages = collections.OrderedDict()
+        # Packages added before the first stage go with it
+        bounds = [ (self.install_stages[0][0], 0) ] + self.install_stages[1:] + [ (None, len(self.packages)) ]
+        for i in range(len(bounds) - 1):
+            name, start = bounds[i]
+            end = bounds[i + 1][1]
+            stages.setdefault(name, []).extend(self.packages[start:end])
+
+        return [ (name, pkgs) for name, pkgs in stages.items() if len(pkgs) > 0 ]
+
+    def load_install_checkpoint(self):
+        path = os.path.join(self.dest_dir, _install_stages_file)
+        try:
+            with open(path, "rt") as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def save_install_checkpoint(self, checkpoint):
+        path = os.path.join(self.dest_dir, _install_stages_file)
+        try:
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path + ".part", "wt") as f:
+                json.dump(checkpoint, f)
+            os.rename(path + ".part", path)
+        except (IOError, OSError) as e:
+            self.queue_event('debug', "Can't save install checkpoint: %s" % e)
+
     def install_packages(self):
         self.chroot_mount()        
-        self.run_pacman()
-        self.chroot_umount()
+        try:
+            self.run_pacman()
+        finally:
+            self.chroot_umount()
     
     def run_pacman(self):
-        self.pac.install_packages(self.packages, self.conflicts)
+        ''' Installs the packages in stages (base system, desktop, drivers
+        and extras), one transaction each. Committed stages are recorded in
+        the target, so a retried install skips them (if the target hasn't
+        been formatted again, see _install_stages_file) '''
+        checkpoint = self.load_install_checkpoint()
+
+        for name, pkgs in self.get_install_stages():
+            if checkpoint.get(name) == sorted(pkgs):
+                self.queue_event('debug', "Stage '%s' is already installed" % name)
+                continue
+
+            self.queue_event('debug', "Installing stage '%s' (%d packages)" % (name, len(pkgs)))
+            if self.settings.get("predecompress"):
+                ok = self.install_decompressed_packages(pkgs)
+            else:
+                ok = self.pac.install_packages(pkgs, self.conflicts)
+                if ok:
+                    # libalpm keeps the install reason of the packages an
+                    # earlier stage installed as dependencies
+                    self.pac.mark_as_explicit(self.pac.get_package_names(pkgs, self.conflicts))
+            if not ok:
+                raise InstallError(_("Can't install the packages of the '%s' stage") % name)
+
+            checkpoint[name] = sorted(pkgs)
+            self.save_install_checkpoint(checkpoint)
     
+    def install_decompressed_packages(self, pkgs):
+        ''' Installs pkgs and all their dependencies from packages that
+        have been decompressed in parallel beforehand '''
+        ordered, explicit = self.pac.get_install_order(pkgs, self.conflicts)
+        if len(ordered) == 0:
+            return self.pac.install_packages(pkgs, self.conflicts)
+
+        cache_dir = "%s/var/cache/pacman/pkg" % self.dest_dir
+        out_dir = self.get_decompressed_dir()
+
+        self.queue_event('info', _("Decompressing packages..."))
+        download_queue = self.pac.get_download_queue(ordered)
+        local_files = package_decompress.decompress_packages(download_queue, cache_dir, out_dir)
+        self.queue_event('debug', "%d of %d packages decompressed" % (len(local_files), len(ordered)))
+
+        try:
+            # The whole closure is added explicitly, so libalpm takes every
+            # package from our files
+            ok = self.pac.install_packages([ pkg.name for pkg in ordered ], self.conflicts, local_files)
+        finally:
+            shutil.rmtree(out_dir, ignore_errors=True)
+
+        explicit = set(explicit)
+        self.pac.mark_as_dependencies([ pkg.name for pkg in ordered if pkg.name not in explicit ])
+        # An earlier stage may have installed some of them as dependencies
+        self.pac.mark_as_explicit(list(explicit))
+
+        return ok
+
+    def get_decompressed_dir(self):
+        return "%s/var/cache/cnchi/decompressed" % self.dest_dir
+
     def chroot_mount(self):
+        ''' Mounts sys, proc and dev in the target. Tasks that run at the
+        same time share the mounts, which are only umounted when the last
+        of them calls chroot_umount '''
+        with self.chroot_lock:
+            self.chroot_users += 1
+            if self.chroot_users > 1:
+                return
+            try:
+                self.mount_special_dirs()
+            except:
+                self.chroot_users -= 1
+                raise
+
+    def chroot_umount(self):
+        with self.chroot_lock:
+            self.chroot_users -= 1
+            if self.chroot_users == 0:
+                self.umount_special_dirs()
+
+    def mount_special_dirs(self):
         dirs = [ "sys", "proc", "dev" ]
         for d in dirs:
             mydir = os.path.join(self.dest_dir, d)
@@ -527,7 +859,7 @@ class InstallationProcess(Process):
         mydir = os.path.join(self.dest_dir, "dev")
         subprocess.check_call(["mount", "-o", "bind", "/dev", mydir])
         
-    def chroot_umount(self):
+    def umount_special_dirs(self):
         dirs = [ "proc", "sys", "dev" ]
         
         for d in dirs:
@@ -700,6 +1032,10 @@ class InstallationProcess(Process):
 
     # runs mkinitcpio on the target system
     def run_mkinitcpio(self):
+        # Let's start without using hwdetect for mkinitcpio.conf.
+        # I think it should work out of the box most of the time.
+        # This way we don't have to fix deprecated hooks.    
+        self.queue_event('info', _("Running mkinitcpio"))
         self.chroot_mount()
         self.chroot(["/usr/bin/mkinitcpio", "-p", self.kernel_pkg])
         self.chroot_umount()
@@ -719,16 +1055,37 @@ class InstallationProcess(Process):
                     line = line[1:]
                 gen.write(line)
         
-    def configure_system(self):
+    def add_configure_tasks(self, scheduler, deps):
+        ''' Adds the final install steps to scheduler. All of them need
+        the packages installed (deps), but most are independent from each
+        other and can run at the same time '''
         # final install steps
         # set clock, language, timezone
         # run mkinitcpio
         # populate pacman keyring
         # setup systemd services
         # ... check configure_system from arch-setup
+        tasks = [
+            ('fstab', self.auto_fstab, []),
+            ('copy_config', self.copy_config_files, []),
+            ('services', self.enable_system_services, []),
+            ('timezone', self.set_timezone, []),
+            ('user', self.create_user, []),
+            ('locale', self.set_locale, []),
+            ('keyboard', self.set_keyboard, []),
+            ('hwclock', self.auto_timesetting, []),
+            ('autologin', self.set_autologin, [ 'user' ]),
+            # The keymap and fsck hooks read vconsole.conf and fstab
+            ('mkinitcpio', self.run_mkinitcpio, [ 'keyboard', 'fstab' ]),
+            ('postinstall', self.run_postinstall, [ 'user', 'keyboard', 'locale', 'autologin' ]),
+            ('intel', self.set_intel_acceleration, []) ]
+
+        for name, func, task_deps in tasks:
+            scheduler.add(name, func, deps + task_deps)
+
+    def copy_config_files(self):
+        self.queue_event("action", _("Configuring your new system"))
 
-        # Generate the fstab file        
-        self.auto_fstab()
         #Copy configured networks in Live medium to target system
         if self.network_manager == 'NetworkManager':
             self.copy_network_config()
@@ -737,21 +1094,20 @@ class InstallationProcess(Process):
         shutil.copy2('/etc/pacman.d/mirrorlist', \
                     os.path.join(self.dest_dir, 'etc/pacman.d/mirrorlist'))       
 
-        self.queue_event("action", _("Configuring your new system"))
-
         # Copy important config files to target system
         files = [ "/etc/pacman.conf", "/etc/yaourtrc" ]        
         
         for path in files:
             shutil.copy2(path, os.path.join(self.dest_dir, 'etc/'))
 
-        # enable services      
+    def enable_system_services(self):
         self.enable_services([ self.desktop_manager, self.network_manager ])
 
         # TODO: we never ask the user about this...
         if self.settings.get("use_ntp"):
             self.enable_services([ "ntpd" ])
 
+    def set_timezone(self):
         # Wait FOREVER until the user sets the timezone
         while self.settings.get('timezone_done') is False:
             # wait five seconds and try again
@@ -761,7 +1117,8 @@ class InstallationProcess(Process):
         zoneinfo_path = os.path.join("/usr/share/zoneinfo", \
                                      self.settings.get("timezone_zone"))
         self.chroot(['ln', '-s', zoneinfo_path, "/etc/localtime"])
-        
+
+    def create_user(self):
         # Wait FOREVER until the user sets his params
         while self.settings.get('user_info_done') is False:
             # wait five seconds and try again
@@ -799,9 +1156,8 @@ class InstallationProcess(Process):
         # User password is the root password  
         self.change_user_password('root', password)
 
+    def set_locale(self):
         ## Generate locales
-        keyboard_layout = self.settings.get("keyboard_layout")
-        keyboard_variant = self.settings.get("keyboard_variant")
         locale = self.settings.get("locale")
         self.queue_event('info', _("Generating locales"))
         
@@ -812,7 +1168,11 @@ class InstallationProcess(Process):
         with open(locale_conf_path, "wt") as locale_conf:
             locale_conf.write('LANG=%s \n' % locale)
             locale_conf.write('LC_COLLATE=C \n')
-            
+
+    def set_keyboard(self):
+        keyboard_layout = self.settings.get("keyboard_layout")
+        keyboard_variant = self.settings.get("keyboard_variant")
+
         # Set /etc/vconsole.conf
         vconsole_conf_path = os.path.join(self.dest_dir, "etc/vconsole.conf")
         with open(vconsole_conf_path, "wt") as vconsole_conf:
@@ -831,7 +1191,8 @@ class InstallationProcess(Process):
                 xorg_conf_xkb.write('        Option "XkbVariant" "%s"\n' % keyboard_variant)
             xorg_conf_xkb.write('EndSection\n')
 
-        self.auto_timesetting()
+    def set_autologin(self):
+        username = self.settings.get('username')
 
         # Set autologin if selected
         if self.settings.get('require_password') is False:
@@ -889,14 +1250,12 @@ class InstallationProcess(Process):
                         if '#autologin-user=' in line:
                             line = 'autologin-user=%s\n' % username
                         lightdm_conf.write(line)
-                
 
-        # Let's start without using hwdetect for mkinitcpio.conf.
-        # I think it should work out of the box most of the time.
-        # This way we don't have to fix deprecated hooks.    
-        self.queue_event('info', _("Running mkinitcpio"))
-        self.run_mkinitcpio()
-        
+    def run_postinstall(self):
+        username = self.settings.get('username')
+        keyboard_layout = self.settings.get("keyboard_layout")
+        keyboard_variant = self.settings.get("keyboard_variant")
+
         # Call post-install script to execute gsettings commands
         script_path_postinstall = os.path.join(self.settings.get("CNCHI_DIR"), \
             "scripts", _postinstall_script)
@@ -917,9 +1276,9 @@ class InstallationProcess(Process):
                         line = 'auto_login yes\n'
                     if 'default_user' in line:
                         line = 'default_user %s\n' % username
-                    lxdm_conf.write(line)
-
+                    conf.write(line)
 
+    def set_intel_acceleration(self):
         # Set SNA acceleration method on Intel cards to avoid GDM bug
         if 'intel' in self.card:
                 intel_conf_path = os.path.join(self.dest_dir, "etc/X11/xorg.conf.d/20-intel.conf")
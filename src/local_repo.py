@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  local_repo.py
+#
+#  Copyright 2013 Antergos
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#  Antergos Team:
+#   Alex Filgueira (faidoc) <alexfilgueira.antergos.com>
+#   Raúl Granados (pollitux) <raulgranados.antergos.com>
+#   Gustau Castells (karasu) <karasu.antergos.com>
+#   Kirill Omelchenko (omelcheck) <omelchek.antergos.com>
+#   Marc Miralles (arcnexus) <arcnexus.antergos.com>
+#   Alex Skinner (skinner) <skinner.antergos.com>
+
+''' Builds a pacman repository from the packages of the live medium (or of
+any other directory, like an USB drive), for offline installs '''
+
+import os
+import subprocess
+
+import log
+
+# Name of the repo (and of its database)
+repo_name = "cnchi-local"
+
+_package_exts = (".pkg.tar.xz", ".pkg.tar.gz", ".pkg.tar")
+
+def find_packages(dirs):
+    ''' Returns the paths of all packages found in dirs (and their
+    subdirs). If a package is in more than one place, the first one wins '''
+    packages = {}
+    for top_dir in dirs:
+        for dirpath, dirnames, filenames in os.walk(top_dir, followlinks=True):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if filename.endswith(_package_exts) and filename not in packages:
+                    packages[filename] = os.path.join(dirpath, filename)
+    return packages
+
+def create_local_repo(dirs, repo_dir):
+    ''' Links all packages found in dirs into repo_dir and creates its
+    database with repo-add. The database is only created again if the
+    package list changes. Returns the number of packages in the repo '''
+    packages = find_packages(dirs)
+    if len(packages) == 0:
+        return 0
+
+    if not os.path.exists(repo_dir):
+        os.makedirs(repo_dir)
+
+    for filename, path in packages.items():
+        for suffix in [ "", ".sig" ]:
+            link = os.path.join(repo_dir, filename + suffix)
+            if os.path.exists(path + suffix) and not os.path.lexists(link):
+                os.symlink(path + suffix, link)
+
+    db_path = os.path.join(repo_dir, repo_name + ".db.tar.gz")
+    list_path = os.path.join(repo_dir, ".packages")
+    package_list = "\n".join(sorted(packages.keys()))
+
+    if os.path.exists(db_path) and os.path.exists(list_path):
+        with open(list_path, "rt") as f:
+            if f.read() == package_list:
+                log.debug(_("Local repository is up to date"))
+                return len(packages)
+
+    if os.path.exists(db_path):
+        os.remove(db_path)
+
+    cmd = [ "repo-add", "--quiet", db_path ]
+    cmd += [ os.path.join(repo_dir, filename) for filename in sorted(packages.keys()) ]
+    subprocess.check_call(cmd)
+
+    with open(list_path, "wt") as f:
+        f.write(package_list)
+
+    return len(packages)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  package_cache.py
+#
+#  Copyright 2013 Antergos
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#  Antergos Team:
+#   Alex Filgueira (faidoc) <alexfilgueira.antergos.com>
+#   Raúl Granados (pollitux) <raulgranados.antergos.com>
+#   Gustau Castells (karasu) <karasu.antergos.com>
+#   Kirill Omelchenko (omelcheck) <omelchek.antergos.com>
+#   Marc Miralles (arcnexus) <arcnexus.antergos.com>
+#   Alex Skinner (skinner) <skinner.antergos.com>
+
+''' Helpers to find packages that are already in a pacman cache dir
+(for instance, the ones in the live medium) '''
+
+import os
+import shutil
+import hashlib
+import fcntl
+
+import log
+
+# ioctl to clone a file on filesystems that support it (btrfs, xfs...)
+_FICLONE = 0x40049409
+
+def get_checksum(path, algorithm):
+    checksum = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1048576), b''):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+def file_matches(path, item):
+    ''' Checks that path is the file described by a download queue item
+    (same size and checksum as in the sync db) '''
+    try:
+        if os.path.getsize(path) != item['size']:
+            return False
+        if item.get('sha256sum'):
+            return get_checksum(path, 'sha256') == item['sha256sum']
+        if item.get('md5sum'):
+            return get_checksum(path, 'md5') == item['md5sum']
+    except (IOError, OSError):
+        return False
+    # Nothing to compare with, we can't trust it
+    return False
+
+def find_in_cache_dirs(item, cache_dirs):
+    ''' Returns the path of an identical file in cache_dirs, or None '''
+    for cache_dir in cache_dirs:
+        path = os.path.join(cache_dir, item['filename'])
+        if os.path.exists(path) and file_matches(path, item):
+            return path
+    return None
+
+def reflink(src, dst):
+    with open(src, "rb") as src_file:
+        with open(dst, "wb") as dst_file:
+            fcntl.ioctl(dst_file.fileno(), _FICLONE, src_file.fileno())
+
+def link_or_copy(src, dst):
+    ''' Puts src in dst without copying its data if possible: tries a
+    hardlink first, then a reflink and copies the file as a last resort '''
+    if os.path.exists(dst):
+        os.remove(dst)
+
+    try:
+        os.link(src, dst)
+        return "link"
+    except OSError:
+        pass
+
+    try:
+        reflink(src, dst)
+        return "reflink"
+    except (IOError, OSError):
+        if os.path.exists(dst):
+            os.remove(dst)
+
+    shutil.copy2(src, dst)
+    return "copy"
+
+def seed_download_queue(download_queue, cache_dir, local_cache_dirs, file_callback=None):
+    ''' Removes from the download queue the files that are already in
+    cache_dir or in any of local_cache_dirs (like the packages in the live
+    medium). Files found in local_cache_dirs are linked into cache_dir.
+    file_callback is called with the path of every file we already have '''
+    to_download = []
+    for item in download_queue:
+        dst = os.path.join(cache_dir, item['filename'])
+        if file_matches(dst, item):
+            found = dst
+        else:
+            found = find_in_cache_dirs(item, local_cache_dirs)
+            if found != None:
+                try:
+                    how = link_or_copy(found, dst)
+                    log.debug(_("Using local file %s (%s)") % (found, how))
+                    found = dst
+                except (IOError, OSError) as e:
+                    log.debug(_("Can't use local file %s: %s") % (found, e))
+                    found = None
+
+        if found == None:
+            to_download.append(item)
+        elif file_callback != None:
+            file_callback(found)
+
+    return to_download
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  package_closures.py
+#
+#  Copyright 2013 Antergos
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#  Antergos Team:
+#   Alex Filgueira (faidoc) <alexfilgueira.antergos.com>
+#   Raúl Granados (pollitux) <raulgranados.antergos.com>
+#   Gustau Castells (karasu) <karasu.antergos.com>
+#   Kirill Omelchenko (omelcheck) <omelchek.antergos.com>
+#   Marc Miralles (arcnexus) <arcnexus.antergos.com>
+#   Alex Skinner (skinner) <skinner.antergos.com>
+
+''' Precomputed dependency closures published in packages.xml.
+
+The server resolves the packages of each desktop and hardware profile
+against a snapshot of the sync databases (see generate-package-closures.py)
+and stores the result in a <closures> element:
+
+    <closures snapshot="sha256 of the sync dbs">
+        <closure desktop="gnome" profile="intel" key="sha256 of the input">
+            <package name="..." version="..." filename="..." repo="..."
+                     size="..." isize="..." md5sum="..." sha256sum="..."
+                     explicit="true"/>
+            <remove name="..."/>
+            <input name="..."/>
+            <conflict name="..."/>
+        </closure>
+    </closures>
+
+input and conflict elements are the package list and conflicts that were
+resolved. A closure is only used when the client's sync dbs are the same
+snapshot. Its package list doesn't have to be the client's one: the closure
+of the desktop (and drivers) is used when the client's list has all its
+packages, and only the rest of them (filesystems, extras...) are resolved
+on the client (see Pac.get_precomputed) '''
+
+import hashlib
+import xml.etree.ElementTree as etree
+
+import package_selection
+
+# Sections added after the desktop ones, in the order select_packages uses
+profile_sections = [ 'ntp', 'ati', 'nvidia', 'intel', 'virtualbox', 'vmware', 'via',
+                     'broadcom', 'ntfs', 'btrfs', 'nilfs2', 'ext', 'reiserfs', 'xfs',
+                     'jfs', 'vfat', 'third_party', 'chinese' ]
+
+def get_key(package_names, conflicts):
+    ''' Identifies a package selection (order and duplicates don't matter) '''
+    key = hashlib.sha256()
+    key.update("\n".join(sorted(set(package_names))).encode())
+    key.update(b"\0")
+    key.update("\n".join(sorted(set(conflicts))).encode())
+    return key.hexdigest()
+
+def get_package_names(index, desktop, sections):
+    ''' Returns the package names and conflicts select_packages would choose
+    for desktop with the optional sections given (from profile_sections).
+    index is the packages.xml index made by package_selection '''
+    rules = [
+        ('base', 'common_system', None),
+        ('desktop', '%(desktop)s_desktop', None),
+        ('extras', '%(sections)s', None),
+        ('base', 'grub', None) ]
+    facts = {
+        'desktop': desktop,
+        'sections': [ section for section in profile_sections if section in sections ] }
+
+    package_names = []
+    conflicts = []
+    for stage, pkgname, attributes in package_selection.select(index, facts, rules):
+        if attributes.get('conflicts'):
+            conflicts.append(attributes.get('conflicts'))
+        package_names.append(pkgname)
+
+    return package_names, conflicts
+
+def create_closure_element(desktop, profile, package_names, conflicts, pkgs, explicit, to_remove):
+    ''' package_names and conflicts are what has been resolved. pkgs are
+    pyalpm packages, sorted in install order '''
+    key = get_key(package_names, conflicts)
+    closure = etree.Element('closure', desktop=desktop, profile=profile, key=key)
+    explicit = set(explicit)
+    for pkg in pkgs:
+        attrib = {
+            'name': pkg.name,
+            'version': pkg.version,
+            'filename': pkg.filename,
+            'repo': pkg.db.name,
+            'size': str(pkg.size),
+            'isize': str(pkg.isize),
+            'md5sum': pkg.md5sum or "",
+            'sha256sum': pkg.sha256sum or "" }
+        if pkg.name in explicit:
+            attrib['explicit'] = "true"
+        etree.SubElement(closure, 'package', attrib)
+    for name in to_remove:
+        etree.SubElement(closure, 'remove', name=name)
+    for name in sorted(set(package_names)):
+        etree.SubElement(closure, 'input', name=name)
+    for name in sorted(set(conflicts)):
+        etree.SubElement(closure, 'conflict', name=name)
+    return closure
+
+def find_closure(root, snapshot, package_names, conflicts):
+    ''' Returns the biggest closure for the sync dbs snapshot that covers
+    part of package_names, or None if the server hasn't published any.
+    The closure is a dict with the packages (dicts with their name and
+    version, in install order), the names of the explicit ones, the names
+    of the packages to remove, the package list and conflicts it was made
+    with (input and conflicts) and the packages of package_names it doesn't
+    cover (remainder) '''
+    package_names = set(package_names)
+    conflicts = set(conflicts)
+    best = None
+    best_input = set()
+    for closures in root.iter('closures'):
+        if closures.attrib.get('snapshot') != snapshot:
+            continue
+        for closure in closures.iter('closure'):
+            closure_input = set(element.attrib['name'] for element in closure.iter('input'))
+            closure_conflicts = set(element.attrib['name'] for element in closure.iter('conflict'))
+            if len(closure_input) == 0 or len(closure_input) <= len(best_input):
+                continue
+            if closure.attrib.get('key') != get_key(closure_input, closure_conflicts):
+                continue
+            if not closure_input <= package_names or not closure_conflicts <= conflicts:
+                continue
+            # Our conflicts can't be installed, not even as dependencies
+            names = set(pkg.attrib['name'] for pkg in closure.iter('package'))
+            if len(names & (conflicts - closure_conflicts)) > 0:
+                continue
+            best = closure
+            best_input = closure_input
+
+    if best == None:
+        return None
+
+    packages = []
+    explicit = []
+    for pkg in best.iter('package'):
+        # The rest (filename, checksums...) is taken from our sync dbs
+        packages.append({ 'name': pkg.attrib['name'], 'version': pkg.attrib['version'] })
+        if pkg.attrib.get('explicit') == "true":
+            explicit.append(pkg.attrib['name'])
+    to_remove = [ remove.attrib['name'] for remove in best.iter('remove') ]
+    return {
+        'packages': packages,
+        'explicit': explicit,
+        'to_remove': to_remove,
+        'input': sorted(best_input),
+        'conflicts': [ element.attrib['name'] for element in best.iter('conflict') ],
+        'remainder': sorted(package_names - best_input) }
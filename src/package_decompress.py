@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  package_decompress.py
+#
+#  Copyright 2013 Antergos
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#  Antergos Team:
+#   Alex Filgueira (faidoc) <alexfilgueira.antergos.com>
+#   Raúl Granados (pollitux) <raulgranados.antergos.com>
+#   Gustau Castells (karasu) <karasu.antergos.com>
+#   Kirill Omelchenko (omelcheck) <omelchek.antergos.com>
+#   Marc Miralles (arcnexus) <arcnexus.antergos.com>
+#   Alex Skinner (skinner) <skinner.antergos.com>
+
+''' Decompresses cached packages in a pool of processes before installing
+them. libalpm reads plain .pkg.tar files just fine, so it only has to copy
+the files out of them instead of running a single xz stream per package.
+
+Every package is checked against the checksum in the sync db before it is
+decompressed: packages installed from a file don't go through that check '''
+
+import os
+import lzma
+import shutil
+import concurrent.futures
+
+import log
+import package_cache
+
+_block_size = 1048576
+
+def decompress_package(path, item, out_dir):
+    ''' Runs in a worker process. Returns (filename, path of the decompressed
+    package or None, reason) '''
+    filename = item['filename']
+    if not filename.endswith(".xz"):
+        return filename, None, "not xz compressed"
+    if not package_cache.file_matches(path, item):
+        return filename, None, "checksum"
+
+    out_path = os.path.join(out_dir, filename[:-3])
+    try:
+        with lzma.open(path, "rb") as src:
+            with open(out_path + ".part", "wb") as dst:
+                shutil.copyfileobj(src, dst, _block_size)
+        os.rename(out_path + ".part", out_path)
+    except (IOError, OSError, lzma.LZMAError) as e:
+        if os.path.exists(out_path + ".part"):
+            os.remove(out_path + ".part")
+        return filename, None, str(e)
+
+    return filename, out_path, ""
+
+def decompress_packages(download_queue, cache_dir, out_dir, workers=None):
+    ''' Decompresses the packages of download_queue found in cache_dir into
+    out_dir. Returns a dict with the path of each decompressed package,
+    by package filename. Packages that can't be decompressed are left out
+    (they'll be installed as usual) '''
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    if workers == None:
+        workers = os.cpu_count() or 1
+
+    local_files = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for item in download_queue:
+            path = os.path.join(cache_dir, item['filename'])
+            if os.path.exists(path):
+                futures.append(executor.submit(decompress_package, path, item, out_dir))
+
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                filename, out_path, reason = future.result()
+            except Exception as e:
+                log.debug(_("Can't decompress package: %s") % e)
+                continue
+            if out_path == None:
+                log.debug(_("Can't decompress %s (%s)") % (filename, reason))
+            else:
+                local_files[filename] = out_path
+
+    return local_files
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  package_list.py
+#
+#  Copyright 2013 Antergos
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#  Antergos Team:
+#   Alex Filgueira (faidoc) <alexfilgueira.antergos.com>
+#   Raúl Granados (pollitux) <raulgranados.antergos.com>
+#   Gustau Castells (karasu) <karasu.antergos.com>
+#   Kirill Omelchenko (omelcheck) <omelchek.antergos.com>
+#   Marc Miralles (arcnexus) <arcnexus.antergos.com>
+#   Alex Skinner (skinner) <skinner.antergos.com>
+
+
+''' Gets packages.xml from our server, keeping a copy of it.
+
+The copy is revalidated with a conditional GET (If-None-Match /
+If-Modified-Since), and we never wait for the server more than _timeout
+seconds in total. If it is too slow or can't be reached, the copy we have
+is used. A copy that has been checked recently (for instance, by the
+prefetch thread started when the installer starts) is used without asking
+the server again. '''
+
+import os
+import json
+import time
+import socket
+import hashlib
+import threading
+import http.client
+import urllib.error
+import xml.etree.ElementTree as etree
+
+import log
+from pacman import db_refresh
+
+_url = "http://install.antergos.com/packages.xml"
+
+# Max seconds we wait for the server
+_timeout = 10
+
+# A copy checked less than these seconds ago is used as it is
+_max_age = 600
+
+_xml_filename = "cnchi-packages.xml"
+_meta_filename = "cnchi-packages.json"
+
+def read_cached(cache_dir):
+    ''' Returns our copy of packages.xml and what we know about it
+    (validators, when it was last checked), or (None, {}) '''
+    try:
+        with open(os.path.join(cache_dir, _xml_filename), "rb") as f:
+            data = f.read()
+    except (IOError, OSError):
+        return None, {}
+
+    try:
+        with open(os.path.join(cache_dir, _meta_filename), "rt") as f:
+            meta = json.load(f)
+    except (IOError, ValueError):
+        meta = {}
+
+    # The copy could have been replaced by another process
+    if meta.get('sha256') != hashlib.sha256(data).hexdigest():
+        meta = {}
+
+    return data, meta
+
+def save_meta(cache_dir, meta):
+    path = os.path.join(cache_dir, _meta_filename)
+    try:
+        with open(path + ".part", "wt") as f:
+            json.dump(meta, f)
+        os.replace(path + ".part", path)
+    except (IOError, OSError) as e:
+        log.debug(_("Can't store packages.xml validators: %s") % e)
+
+def refresh(cache_dir, url=_url, timeout=_timeout):
+    ''' Downloads packages.xml if it has changed since we got our copy.
+    Returns True if our copy is up to date '''
+    data, meta = read_cached(cache_dir)
+    validators = None
+    if data != None:
+        validators = meta
+
+    xml_path = os.path.join(cache_dir, _xml_filename)
+    part_path = "%s.part-%d-%d" % (xml_path, os.getpid(), threading.get_ident())
+
+    try:
+        new_validators = db_refresh.fetch(url, part_path, validators, timeout)
+        # Don't keep anything that isn't a packages.xml (a captive portal
+        # page, for instance)
+        with open(part_path, "rb") as f:
+            new_data = f.read()
+        etree.fromstring(new_data)
+    except db_refresh.NotModified:
+        meta['checked'] = time.time()
+        save_meta(cache_dir, meta)
+        return True
+    except (urllib.error.URLError, http.client.HTTPException, socket.timeout, \
+            OSError, etree.ParseError) as e:
+        log.debug(_("Can't get %s: %s") % (url, e))
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        return False
+
+    os.replace(part_path, xml_path)
+    new_validators['sha256'] = hashlib.sha256(new_data).hexdigest()
+    new_validators['checked'] = time.time()
+    save_meta(cache_dir, new_validators)
+    return True
+
+class PrefetchThread(threading.Thread):
+    ''' Refreshes our copy of packages.xml in the background '''
+    def __init__(self, cache_dir, url=_url, timeout=_timeout):
+        super(PrefetchThread, self).__init__()
+        self.daemon = True
+        self.cache_dir = cache_dir
+        self.url = url
+        self.timeout = timeout
+
+    def run(self):
+        refresh(self.cache_dir, self.url, self.timeout)
+
+def get_package_list(cache_dir, fallback_path, url=_url, timeout=_timeout, max_age=_max_age):
+    ''' Returns the contents of packages.xml: our copy, refreshed first if
+    it hasn't been checked for max_age seconds. If we don't have a copy
+    and the server can't give us one, the file in fallback_path '''
+    data, meta = read_cached(cache_dir)
+
+    if data == None or time.time() - meta.get('checked', 0) > max_age:
+        thread = PrefetchThread(cache_dir, url, timeout)
+        thread.start()
+        thread.join(timeout)
+        if thread.is_alive():
+            log.debug(_("The server is too slow, not waiting for %s") % url)
+        data, meta = read_cached(cache_dir)
+
+    if data == None:
+        log.debug(_("Can't retrieve remote package list, using %s instead.") % fallback_path)
+        with open(fallback_path, "rb") as f:
+            data = f.read()
+
+    return data
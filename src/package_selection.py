@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  package_selection.py
+#
+#  Copyright 2013 Antergos
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#  Antergos Team:
+#   Alex Filgueira (faidoc) <alexfilgueira.antergos.com>
+#   Raúl Granados (pollitux) <raulgranados.antergos.com>
+#   Gustau Castells (karasu) <karasu.antergos.com>
+#   Kirill Omelchenko (omelcheck) <omelchek.antergos.com>
+#   Marc Miralles (arcnexus) <arcnexus.antergos.com>
+#   Alex Skinner (skinner) <skinner.antergos.com>
+
+
+''' Package selection from packages.xml.
+
+packages.xml is compiled once into an index that maps every element to the
+packages (pkgname elements) inside it, the same ones root.iter(tag) would
+find, plus the tags of its children. The index is cached on disk, keyed by
+the hash of the xml file.
+
+Which sections are installed is decided by _rules, evaluated against a dict
+of facts about this installation (desktop, drivers, filesystems...). '''
+
+import os
+import re
+import json
+import hashlib
+import xml.etree.ElementTree as etree
+
+import log
+
+# Each rule is (install stage, section, fact). The rule only applies if the
+# fact (when given) is true. Sections can use a fact as %(fact)s. If the
+# fact is a list, the rule is applied once per item.
+_rules = [
+    ('base', 'common_system', None),
+    ('desktop', '%(desktop)s_desktop', None),
+    ('desktop', 'ntp', 'use_ntp'),
+    ('drivers', '%(drivers)s', None),
+    ('drivers', '%(filesystems)s', None),
+    ('extras', 'third_party', 'third_party_software'),
+    ('extras', 'chinese', 'chinese_fonts'),
+    ('base', 'grub', None) ]
+
+_fact_re = re.compile(r"%\((\w+)\)s")
+
+_index_version = 1
+
+def compile_index(root):
+    ''' Returns { 'sections': { tag: [ (pkgname, attributes) ] },
+    'children': { tag: [ child tags ] } } '''
+    sections = {}
+    children = {}
+
+    def walk(element, ancestors):
+        if element.tag == 'closures':
+            # Precomputed closures (see package_closures), not packages
+            return
+        if element.tag == 'pkgname':
+            pkg = (element.text, dict(element.attrib))
+            for tag in ancestors:
+                sections[tag].append(pkg)
+            return
+        tags = children.setdefault(element.tag, [])
+        for child in element:
+            if child.tag != 'pkgname' and child.tag not in tags:
+                tags.append(child.tag)
+        sections.setdefault(element.tag, [])
+        # An element inside another with the same tag must not add
+        # its packages twice
+        if element.tag not in ancestors:
+            ancestors = ancestors + [element.tag]
+        for child in element:
+            walk(child, ancestors)
+
+    walk(root, [])
+    return { 'sections': sections, 'children': children }
+
+def load_index(data, cache_file=None):
+    ''' Returns the index of the packages.xml contents in data (bytes),
+    from cache_file if it was made with the same contents '''
+    xml_hash = hashlib.sha256(data).hexdigest()
+
+    if cache_file != None:
+        try:
+            with open(cache_file, "rt") as f:
+                cached = json.load(f)
+            if cached['hash'] == xml_hash and cached['version'] == _index_version:
+                return cached['index']
+        except (IOError, ValueError, KeyError):
+            pass
+
+    index = compile_index(etree.fromstring(data))
+
+    if cache_file != None:
+        try:
+            with open(cache_file + ".part", "wt") as f:
+                json.dump({ 'hash': xml_hash, 'version': _index_version, 'index': index }, f)
+            os.rename(cache_file + ".part", cache_file)
+        except (IOError, OSError) as e:
+            log.debug(_("Can't store packages.xml index: %s") % e)
+
+    # Same types we would get from the cache
+    return json.loads(json.dumps(index))
+
+def get_filesystem_sections(index, fs_types):
+    ''' Returns the sections of packages.xml needed by fs_types (as
+    reported by blkid) '''
+    found = []
+    for section in index['children'].get('filesystems', []):
+        for fs_type in fs_types:
+            if fs_type.startswith(section) and section not in found:
+                found.append(section)
+    return found
+
+def expand(section, facts):
+    ''' Returns the sections a rule refers to '''
+    match = _fact_re.search(section)
+    if match == None:
+        return [ section ]
+    value = facts.get(match.group(1))
+    if value == None:
+        return []
+    if not isinstance(value, list):
+        value = [ value ]
+    return [ section.replace(match.group(0), str(item)) for item in value ]
+
+def select(index, facts, rules=None):
+    ''' Returns a list of (install stage, pkgname, attributes) with all
+    packages that must be installed, in rule order '''
+    if rules == None:
+        rules = _rules
+    selected = []
+    for stage, section, fact in rules:
+        if fact != None and not facts.get(fact):
+            continue
+        for name in expand(section, facts):
+            for pkgname, attributes in index['sections'].get(name, []):
+                selected.append((stage, pkgname, attributes))
+    return selected
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  package_verify.py
+#
+#  Copyright 2013 Antergos
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#  Antergos Team:
+#   Alex Filgueira (faidoc) <alexfilgueira.antergos.com>
+#   Raúl Granados (pollitux) <raulgranados.antergos.com>
+#   Gustau Castells (karasu) <karasu.antergos.com>
+#   Kirill Omelchenko (omelcheck) <omelchek.antergos.com>
+#   Marc Miralles (arcnexus) <arcnexus.antergos.com>
+#   Alex Skinner (skinner) <skinner.antergos.com>
+
+
+''' Checks downloaded packages in a pool of processes as soon as each one
+is complete, instead of waiting for libalpm to check all of them serially
+once every download has finished. Only checksums are checked here:
+signatures are left to libalpm, which checks them when installing '''
+
+import os
+import threading
+import concurrent.futures
+
+import log
+import package_cache
+
+def verify_package(path, item):
+    ''' Runs in a worker process. Returns (path, ok, reason) '''
+    if not package_cache.file_matches(path, item):
+        return path, False, "checksum"
+    return path, True, ""
+
+class PackageVerifier(object):
+    ''' Verifies files in a process pool. on_verified(path) is called
+    (from a thread of the pool) for every good file. Bad files are removed
+    and can be retrieved with pop_corrupt() to download them again '''
+    def __init__(self, workers=None, on_verified=None):
+        self.on_verified = on_verified
+
+        if workers == None:
+            workers = os.cpu_count() or 1
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+
+        self.lock = threading.Lock()
+        self.done = threading.Condition(self.lock)
+        self.pending = 0
+        self.items = {}
+        self.corrupt = []
+
+    def submit(self, path, item):
+        future = self.executor.submit(verify_package, path, item)
+        with self.lock:
+            self.items[path] = item
+            self.pending += 1
+        future.add_done_callback(lambda future: self.on_done(path, future))
+
+    def verify_async(self, loop, path, item):
+        ''' Same check as submit(), but returns an asyncio future with the
+        result of verify_package() (for the internal downloader) '''
+        return loop.run_in_executor(self.executor, verify_package, path, item)
+
+    def add_verified(self, path, item):
+        ''' Records a file that has been checked by other means '''
+        if self.on_verified != None:
+            self.on_verified(path)
+
+    def on_done(self, path, future):
+        try:
+            self.check_result(path, future)
+        finally:
+            with self.lock:
+                self.pending -= 1
+                self.done.notify_all()
+
+    def check_result(self, path, future):
+        with self.lock:
+            item = self.items.pop(path)
+
+        try:
+            path, ok, reason = future.result()
+        except Exception as e:
+            # The pool is broken. Leave the check to libalpm
+            log.debug(_("Can't verify package %s: %s") % (path, e))
+            if self.on_verified != None:
+                self.on_verified(path)
+            return
+
+        if ok:
+            self.add_verified(path, item)
+            return
+
+        log.debug(_("Package %s is corrupt (%s), downloading it again") % (item['filename'], reason))
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        with self.lock:
+            self.corrupt.append(item)
+
+    def pop_corrupt(self):
+        with self.lock:
+            corrupt = self.corrupt
+            self.corrupt = []
+        return corrupt
+
+    def wait(self):
+        ''' Blocks until all submitted files have been checked '''
+        with self.lock:
+            while self.pending > 0:
+                self.done.wait()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
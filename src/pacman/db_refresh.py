@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  db_refresh.py
+#
+#  Copyright 2013 Antergos
+#  
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#  
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#  
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#  
+#  Antergos Team:
+#   Alex Filgueira (faidoc) <alexfilgueira.antergos.com>
+#   Raúl Granados (pollitux) <raulgranados.antergos.com>
+#   Gustau Castells (karasu) <karasu.antergos.com>
+#   Kirill Omelchenko (omelcheck) <omelchek.antergos.com>
+#   Marc Miralles (arcnexus) <arcnexus.antergos.com>
+#   Alex Skinner (skinner) <skinner.antergos.com>
+
+''' Downloads all sync databases at the same time (libalpm updates them
+one after the other). Each repo tries its servers in order, with a
+timeout, and asks them for the database only if it has changed since the
+last refresh (If-None-Match / If-Modified-Since). New databases are moved
+into DBPath/sync once all of them have been downloaded. '''
+
+import os
+import json
+import shutil
+import socket
+import tempfile
+import http.client
+import urllib.request
+import urllib.error
+import email.utils
+import concurrent.futures
+
+# Seconds to wait for a server before trying the next one
+_timeout = 10
+
+# ETag and Last-Modified of each database we have downloaded
+_state_filename = ".cnchi-refresh.json"
+
+class NotModified(Exception):
+    pass
+
+def fetch(url, path, validators=None, timeout=_timeout):
+    ''' Downloads url to path. If validators (ETag / Last-Modified of our
+    copy) are given and the file hasn't changed, raises NotModified.
+    Returns the validators of the new file '''
+    request = urllib.request.Request(url, headers={ 'User-Agent': 'Cnchi' })
+    if validators != None:
+        if validators.get('etag'):
+            request.add_header('If-None-Match', validators['etag'])
+        if validators.get('last_modified'):
+            request.add_header('If-Modified-Since', validators['last_modified'])
+
+    try:
+        response = urllib.request.urlopen(request, timeout=timeout)
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            raise NotModified()
+        raise
+
+    with response:
+        with open(path, "wb") as f:
+            shutil.copyfileobj(response, f)
+        return {
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified') }
+
+def get_validators(state, repo, db_path):
+    ''' Returns what we know about our copy of a repo database (None if
+    we don't have it) '''
+    if not os.path.exists(db_path):
+        return None
+    validators = dict(state.get(repo, {}))
+    if not validators.get('etag') and not validators.get('last_modified'):
+        validators['last_modified'] = email.utils.formatdate(os.path.getmtime(db_path), usegmt=True)
+    return validators
+
+def refresh_repo(repo, servers, tmp_dir, validators, timeout=_timeout):
+    ''' Gets the database (and its signature, if there is one) of a repo,
+    trying its servers in order. Returns (status, validators, errors), where
+    status is 'updated', 'unchanged' or 'failed' '''
+    errors = []
+    for server in servers:
+        url = "%s/%s.db" % (server, repo)
+        try:
+            new_validators = fetch(url, os.path.join(tmp_dir, repo + ".db"), validators, timeout)
+        except NotModified:
+            return 'unchanged', validators, errors
+        except (urllib.error.URLError, http.client.HTTPException, socket.timeout, OSError) as e:
+            errors.append("%s: %s" % (url, e))
+            continue
+
+        try:
+            fetch(url + ".sig", os.path.join(tmp_dir, repo + ".db.sig"), None, timeout)
+        except (urllib.error.URLError, http.client.HTTPException, socket.timeout, OSError):
+            # Most repos don't sign their databases
+            pass
+
+        return 'updated', new_validators, errors
+
+    return 'failed', None, errors
+
+def load_state(path):
+    try:
+        with open(path, "rt") as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def refresh_databases(pacman_conf, force=False, timeout=_timeout, sort_servers=None):
+    ''' Refreshes all sync databases of pacman_conf at the same time.
+    sort_servers, if given, is called with the servers of each repo and
+    returns them in the order they must be tried.
+    Returns a dict with the (status, errors) of each repo '''
+    sync_dir = os.path.join(pacman_conf.options["DBPath"], "sync")
+    if not os.path.exists(sync_dir):
+        os.makedirs(sync_dir)
+
+    state_path = os.path.join(sync_dir, _state_filename)
+    state = load_state(state_path)
+
+    # Same filesystem as sync_dir, so files can be renamed into it
+    tmp_dir = tempfile.mkdtemp(prefix=".refresh-", dir=sync_dir)
+
+    results = {}
+    try:
+        repos = list(pacman_conf.repos.keys())
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(repos), 1)) as executor:
+            futures = {}
+            for repo in repos:
+                validators = None
+                if not force:
+                    validators = get_validators(state, repo, os.path.join(sync_dir, repo + ".db"))
+                servers = pacman_conf.get_servers(repo)
+                if sort_servers != None:
+                    servers = sort_servers(servers)
+                future = executor.submit(refresh_repo, repo, servers, tmp_dir, validators, timeout)
+                futures[future] = repo
+
+            for future in concurrent.futures.as_completed(futures):
+                results[futures[future]] = future.result()
+
+        # Install all new databases in one go
+        for repo in repos:
+            status, validators, errors = results[repo]
+            if status != 'updated':
+                continue
+            for name in [ repo + ".db", repo + ".db.sig" ]:
+                src = os.path.join(tmp_dir, name)
+                dst = os.path.join(sync_dir, name)
+                if os.path.exists(src):
+                    os.replace(src, dst)
+                elif os.path.exists(dst):
+                    # Old signature of an old database
+                    os.remove(dst)
+            state[repo] = validators
+
+        with open(state_path, "wt") as f:
+            json.dump(state, f)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return dict((repo, (results[repo][0], results[repo][2])) for repo in results)
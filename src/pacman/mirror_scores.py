@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  mirror_scores.py
+#
+#  Copyright 2013 Antergos
+#  
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#  
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#  
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#  
+#  Antergos Team:
+#   Alex Filgueira (faidoc) <alexfilgueira.antergos.com>
+#   Raúl Granados (pollitux) <raulgranados.antergos.com>
+#   Gustau Castells (karasu) <karasu.antergos.com>
+#   Kirill Omelchenko (omelcheck) <omelchek.antergos.com>
+#   Marc Miralles (arcnexus) <arcnexus.antergos.com>
+#   Alex Skinner (skinner) <skinner.antergos.com>
+
+''' Keeps track of how fast (and how reliable) each mirror is, so the
+servers of every repo can be tried fastest first. Scores are stored in a
+file, to be used again the next time '''
+
+import os
+import json
+import urllib.parse
+
+# Old measures count less every time scores are loaded again
+_decay = 0.5
+
+def get_host(url):
+    return urllib.parse.urlsplit(url).netloc
+
+class MirrorScores(object):
+    def __init__(self, path=None):
+        self.path = path
+        # host -> { bytes, seconds, files, failures }
+        self.hosts = {}
+        if path != None:
+            self.load()
+
+    def get_host_stats(self, host):
+        if host not in self.hosts:
+            self.hosts[host] = { 'bytes': 0, 'seconds': 0.0, 'files': 0, 'failures': 0 }
+        return self.hosts[host]
+
+    def add_download(self, url, size, seconds):
+        stats = self.get_host_stats(get_host(url))
+        stats['bytes'] += size
+        stats['seconds'] += seconds
+        stats['files'] += 1
+
+    def add_failure(self, host):
+        stats = self.get_host_stats(host)
+        stats['failures'] += 1
+
+    def is_healthy(self, host):
+        stats = self.hosts[host]
+        return stats['failures'] <= stats['files']
+
+    def get_rate(self, host):
+        stats = self.hosts[host]
+        if stats['seconds'] <= 0:
+            return 0
+        return stats['bytes'] / stats['seconds'] / (1 + stats['failures'])
+
+    def sort_servers(self, servers):
+        ''' Returns servers sorted by score: fastest healthy mirrors first,
+        then the ones we know nothing about (in their original order) and
+        then the failing ones '''
+        def key(i):
+            host = get_host(servers[i])
+            if host not in self.hosts:
+                return (1, 0, i)
+            if not self.is_healthy(host):
+                return (2, -self.get_rate(host), i)
+            return (0, -self.get_rate(host), i)
+        return [ servers[i] for i in sorted(range(len(servers)), key=key) ]
+
+    def load(self):
+        try:
+            with open(self.path, "rt") as f:
+                hosts = json.load(f)
+        except (IOError, ValueError):
+            return
+        for host, stats in hosts.items():
+            try:
+                self.hosts[host] = {
+                    'bytes': stats['bytes'] * _decay,
+                    'seconds': stats['seconds'] * _decay,
+                    'files': stats['files'] * _decay,
+                    'failures': stats['failures'] * _decay }
+            except (KeyError, TypeError):
+                continue
+
+    def save(self):
+        if self.path == None:
+            return
+        try:
+            dirname = os.path.dirname(self.path)
+            if not os.path.exists(dirname):
+                os.makedirs(dirname)
+            with open(self.path + ".part", "wt") as f:
+                json.dump(self.hosts, f, indent=2, sort_keys=True)
+            os.rename(self.path + ".part", self.path)
+        except (IOError, OSError):
+            pass
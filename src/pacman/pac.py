@@ -35,18 +35,228 @@
     
 import traceback
 import sys
+import os
 import locale
 import gettext
 import math
+import time
+import re
 
 from multiprocessing import Queue
 import queue
 
 import pyalpm
 from pacman import pac_config
+from pacman import db_refresh
+from pacman import mirror_scores
+
+# Progress events (action, percent...) are sent at most this often
+_progress_interval = 0.1
+
+# libalpm message when a mirror fails
+_failed_download_re = re.compile(r"failed retrieving file '([^']+)' from ([^ ]+) :")
+
+def get_mount_point(path):
+    ''' Returns the mount point of the filesystem where path is (or would be) '''
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    while not os.path.ismount(path):
+        path = os.path.dirname(path)
+    return path
+
+def get_free_space(path):
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+def strip_version(dep):
+    ''' Returns the package name of a dependency string like 'glibc>=2.17' '''
+    for op in [ '<', '>', '=' ]:
+        dep = dep.split(op)[0]
+    return dep
+
+def sort_by_dependencies(pkgs):
+    ''' Sorts pkgs so that every package comes after the packages it
+    depends on. Dependency cycles are broken keeping the original order '''
+    providers = {}
+    for pkg in pkgs:
+        providers.setdefault(pkg.name, pkg)
+    for pkg in pkgs:
+        for provision in pkg.provides:
+            providers.setdefault(strip_version(provision), pkg)
+
+    ordered = []
+    visited = set()
+
+    for root in pkgs:
+        if root.name in visited:
+            continue
+        visited.add(root.name)
+        # Iterative depth-first search (dependency chains can be long)
+        stack = [ (root, iter(root.depends)) ]
+        while len(stack) > 0:
+            pkg, deps = stack[-1]
+            for dep in deps:
+                dep_pkg = providers.get(strip_version(dep))
+                if dep_pkg != None and dep_pkg.name not in visited:
+                    visited.add(dep_pkg.name)
+                    stack.append((dep_pkg, iter(dep_pkg.depends)))
+                    break
+            else:
+                stack.pop()
+                ordered.append(pkg)
+
+    return ordered
+
+def has_conflicts(pkgs, other_pkgs):
+    ''' Tells if any package of pkgs conflicts with (or replaces) any
+    package of other_pkgs, or the other way round '''
+    def get_names(pkgs):
+        names = set()
+        for pkg in pkgs:
+            names.add(pkg.name)
+            names.update(strip_version(provision) for provision in pkg.provides)
+        return names
+
+    def get_conflicts(pkgs):
+        conflicts = set()
+        for pkg in pkgs:
+            conflicts.update(strip_version(dep) for dep in pkg.conflicts + pkg.replaces)
+        return conflicts
+
+    return len(get_conflicts(pkgs) & get_names(other_pkgs)) > 0 or \
+        len(get_conflicts(other_pkgs) & get_names(pkgs)) > 0
+
+class PackageIndex(object):
+    ''' Maps package and group names to sync db packages, so looking up
+    a name doesn't have to go through all repos. Repos are indexed in
+    pacman.conf order: the first repo that has a name (as a package or as
+    a group) wins, like pacman does '''
+    def __init__(self, syncdbs, conflicts=None, added=None):
+        if conflicts == None:
+            self.conflicts = set()
+        else:
+            self.conflicts = set(conflicts)
+
+        # Names of the packages already added to the transaction
+        if added == None:
+            self.added = set()
+        else:
+            self.added = set(added)
+
+        # name -> (repo priority, pkg) and (repo priority, members)
+        self.packages = {}
+        self.groups = {}
+
+        # provision -> pkg (only built if needed, see get_provider)
+        self.providers = None
+
+        priority = 0
+        for db in syncdbs:
+            for pkg in db.pkgcache:
+                if pkg.name not in self.packages:
+                    self.packages[pkg.name] = (priority, pkg)
+            for name, pkgs in db.grpcache:
+                if name not in self.groups:
+                    self.groups[name] = (priority, list(pkgs))
+            priority += 1
+
+    def get_pkg(self, name):
+        entry = self.packages.get(name)
+        if entry == None:
+            return None
+        return entry[1]
+
+    def lookup(self, name):
+        ''' Returns the packages name stands for: a package or all the
+        members of a group (except the conflicting ones) '''
+        if name in self.conflicts:
+            return []
+
+        pkg = self.packages.get(name)
+        group = self.groups.get(name)
+
+        if pkg != None and (group == None or pkg[0] <= group[0]):
+            return [ pkg[1] ]
+        if group != None:
+            return [ member for member in group[1] if member.name not in self.conflicts ]
+        return []
+
+    def get_provider(self, dep):
+        ''' Returns a package that satisfies the dependency dep (versions
+        are not checked) '''
+        name = strip_version(dep)
+        pkg = self.get_pkg(name)
+        if pkg != None:
+            return pkg
+        if self.providers == None:
+            self.providers = {}
+            for priority, pkg in sorted(self.packages.values(), key=lambda entry: entry[0]):
+                for provision in pkg.provides:
+                    self.providers.setdefault(strip_version(provision), pkg)
+        return self.providers.get(name)
+
+    def find_missing(self, names):
+        ''' Returns the names, and the dependencies of their whole
+        closure, that can't be found in the indexed repos '''
+        missing = []
+        stack = []
+        for name in names:
+            pkgs = self.lookup(name)
+            if len(pkgs) == 0 and name not in self.conflicts:
+                missing.append(name)
+            stack.extend(pkgs)
+
+        visited = set()
+        while len(stack) > 0:
+            pkg = stack.pop()
+            if pkg.name in visited:
+                continue
+            visited.add(pkg.name)
+            for dep in pkg.depends:
+                provider = self.get_provider(dep)
+                if provider == None:
+                    missing.append("%s (%s)" % (dep, pkg.name))
+                else:
+                    stack.append(provider)
+
+        return missing
+
+    def get_closure(self, names, exclude=None):
+        ''' Returns the packages of names and all their dependencies, except
+        the ones named in exclude (and their own dependencies) '''
+        if exclude == None:
+            exclude = set()
+        stack = []
+        for name in names:
+            stack.extend(self.lookup(name))
+
+        closure = []
+        visited = set(exclude)
+        while len(stack) > 0:
+            pkg = stack.pop()
+            if pkg.name in visited:
+                continue
+            visited.add(pkg.name)
+            closure.append(pkg)
+            for dep in pkg.depends:
+                provider = self.get_provider(dep)
+                if provider != None:
+                    stack.append(provider)
+        return closure
+
+    def add(self, name):
+        ''' Returns the packages of name that haven't been added yet, and
+        marks them as added '''
+        new_pkgs = []
+        for pkg in self.lookup(name):
+            if pkg.name not in self.added:
+                self.added.add(pkg.name)
+                new_pkgs.append(pkg)
+        return new_pkgs
 
 class Pac(object):
-    def __init__(self, conf, callback_queue):
+    def __init__(self, conf, callback_queue, mirror_scores_path=None):
         
         self.callback_queue = callback_queue
         self.t = None
@@ -62,6 +272,15 @@ class Pac(object):
         
         # avoid adding a package that has been added in the past
         self.listofpackages = []
+
+        # Name and group index of the sync dbs (see get_index)
+        self.index = None
+
+        # Package files to be used instead of the ones in the cache
+        self.local_files = {}
+
+        # Resolved closures we've been given (see add_precomputed)
+        self.precomputed = {}
         
         self.action = ""
         self.percent = 0
@@ -70,20 +289,49 @@ class Pac(object):
         self.total_size = 0
         
         self.last_event = {}
+
+        # Progress events waiting to be sent (see queue_progress_event)
+        self.pending_events = {}
+        self.last_progress_time = {}
+
+        # Size and repo of each file the current transaction has to download
+        self.target_sizes = {}
+        self.target_repos = {}
+
+        # When each download started and the hosts that failed to send it
+        self.download_start = {}
+        self.failed_hosts = {}
+
+        # Installed size of each package (set by plan), used to weight
+        # the install progress
+        self.installed_sizes = {}
+        self.installed_total = 0
+        self.installed_done = 0
         
         if conf != None:
-            self.pacman_conf = pac_config.PacmanConfig(conf)
-            self.handle = self.pacman_conf.initialize_alpm()
-            self.handle.dlcb = self.cb_dl
-            self.handle.totaldlcb = self.cb_totaldl
-            self.handle.eventcb = self.cb_event
-            self.handle.questioncb = self.cb_conv
-            self.handle.progresscb = self.cb_progress
-            self.handle.logcb = self.cb_log
+            # conf is the path of a pacman.conf or an already parsed
+            # config (see pac_config.FrozenPacmanConfig)
+            if isinstance(conf, str):
+                self.pacman_conf = pac_config.PacmanConfig(conf)
+            else:
+                self.pacman_conf = conf
+            self.init_handle()
+            # Scores are only kept if we're told where (never in DBPath,
+            # as it belongs to the system being installed)
+            self.mirror_scores = mirror_scores.MirrorScores(mirror_scores_path)
             self.holdpkg = None
             if 'HoldPkg' in self.pacman_conf.options:
                 self.holdpkg = self.pacman_conf.options['HoldPkg']
 
+    def init_handle(self):
+        self.handle = self.pacman_conf.initialize_alpm()
+        self.handle.dlcb = self.cb_dl
+        self.handle.totaldlcb = self.cb_totaldl
+        self.handle.eventcb = self.cb_event
+        self.handle.questioncb = self.cb_conv
+        self.handle.progresscb = self.cb_progress
+        self.handle.logcb = self.cb_log
+
     def init_transaction(self, **options):
         try:
             _t = self.handle.init_transaction(**options)
@@ -94,7 +342,58 @@ class Pac(object):
             self.queue_event("error", line)
             return None
 
+    def get_index(self):
+        ''' Returns the package index of the current transaction '''
+        if self.index == None:
+            added = [ pkg.name for pkg in self.listofpackages ]
+            self.index = PackageIndex(self.handle.get_syncdbs(), self.conflicts, added)
+        return self.index
+
+    def prepare_transaction(self):
+        ''' Prepares the current transaction and stores the size of the
+        files it will download, so cb_dl doesn't have to look for them '''
+        self.t.prepare()
+        self.target_sizes = {}
+        self.target_repos = {}
+        for pkg in self.t.to_add:
+            self.target_sizes[pkg.filename] = pkg.size
+            self.target_repos[pkg.filename] = pkg.db.name
+        self.download_start = {}
+        self.failed_hosts = {}
+        self.sort_mirrors()
+
+    def sort_mirrors(self):
+        ''' Puts the fastest healthy mirrors first in every sync db. Must not
+        be called while libalpm is downloading '''
+        for db in self.handle.get_syncdbs():
+            servers = list(db.servers)
+            sorted_servers = self.mirror_scores.sort_servers(servers)
+            if sorted_servers != servers:
+                db.servers = sorted_servers
+
+    def add_download_score(self, target, size):
+        ''' Credits a finished download to the mirror that has sent it
+        (the first one of its repo that hasn't failed) '''
+        start = self.download_start.pop(target, None)
+        repo = self.target_repos.get(target)
+        if start == None or repo == None:
+            return
+        failed = self.failed_hosts.pop(target, set())
+        for db in self.handle.get_syncdbs():
+            if db.name != repo:
+                continue
+            for server in db.servers:
+                if mirror_scores.get_host(server) not in failed:
+                    self.mirror_scores.add_download(server, size, time.time() - start)
+                    return
+
     def release_transaction(self):
+        self.index = None
+        self.local_files = {}
+        if len(self.target_sizes) > 0:
+            self.mirror_scores.save()
+        self.target_sizes = {}
+        self.flush_progress_events()
         if self.t != None:
             try:
                 self.t.release()
@@ -103,8 +402,11 @@ class Pac(object):
                 self.queue_event("error", traceback.format_exc())
         
     # Sync databases like pacman -Sy
-    def do_refresh(self):
+    def do_refresh(self, parallel=False):
         self.release_transaction()
+        if parallel:
+            self.do_parallel_refresh()
+            return
         for db in self.handle.get_syncdbs():
             try:
                 self.t = self.init_transaction()                
@@ -120,6 +422,25 @@ class Pac(object):
                 self.queue_event("error", traceback.format_exc())
                 return
 
+    def do_parallel_refresh(self):
+        ''' Downloads all sync databases at the same time (see db_refresh) '''
+        self.queue_event("action", _('Refreshing databases...'))
+        try:
+            results = db_refresh.refresh_databases(self.pacman_conf, \
+                sort_servers=self.mirror_scores.sort_servers)
+        except (IOError, OSError):
+            self.queue_event("error", traceback.format_exc())
+            return
+
+        for repo, (status, errors) in results.items():
+            for error in errors:
+                self.queue_event("debug", error)
+            if status == 'failed':
+                self.queue_event("error", _("Can't download the %s database") % repo)
+
+        # libalpm must load the new databases
+        self.init_handle()
+
     def format_size(self, size):
         KiB_size = size / 1024
         if KiB_size < 1000:
@@ -128,56 +449,290 @@ class Pac(object):
             size_string = '%.2f MiB' % (KiB_size / 1024)
         return size_string
 
-    def install_packages(self, pkg_names, conflicts):
+    def install_packages(self, pkg_names, conflicts, local_files=None):
+        ''' Installs pkg_names in one transaction. Returns False if it fails.
+        local_files maps package filenames to files to install instead of
+        the cached ones (see package_decompress) '''
         self.to_add = []
         self.conflicts = conflicts
+        if local_files == None:
+            self.local_files = {}
+        else:
+            self.local_files = local_files
+        # The index depends on the conflicts list
+        self.index = None
 
         for pkgname in pkg_names:
             self.to_add.append(pkgname)
 
         self.to_remove = []
 
-        if self.to_add and self.t == None:
-            self.t = self.init_transaction()
-            if self.t != None:
-                for pkgname in self.to_add:
-                    self.add_package(pkgname)
-                try:
-                    self.t.prepare()
-                    self.t.commit()
-                    self.release_transaction()
-                except pyalpm.error:
-                    line = traceback.format_exc()
-                    if "pm_errno 25" in line:
-                        pass
-                    else:
-                        self.queue_event("error", line)
+        if not self.to_add:
+            return True
+
+        if self.t != None:
+            self.queue_event("error", _("Can't install packages: another transaction is in progress"))
+            return False
+
+        self.t = self.init_transaction()
+        if self.t == None:
+            return False
+
+        for pkgname in self.to_add:
+            self.add_package(pkgname)
+        try:
+            self.prepare_transaction()
+            self.t.commit()
+            self.release_transaction()
+        except pyalpm.error:
+            # Don't leave the transaction around for the next call
+            self.release_transaction()
+            self.queue_event("error", traceback.format_exc())
+            return False
+        return True
     
+    def add_precomputed(self, pkg_names, conflicts, closure):
+        ''' Sets the result of resolving pkg_names (for instance, a closure
+        published in packages.xml). closure is a dict with the packages to
+        install (dicts with name and version, in install order), the names
+        of the explicit ones and the names of the packages to remove '''
+        self.precomputed[(frozenset(pkg_names), frozenset(conflicts))] = closure
+
+    def find_precomputed(self, pkg_names, conflicts):
+        ''' Returns the biggest closure we've been given that covers part
+        of pkg_names, and the package names it covers '''
+        pkg_names = set(pkg_names)
+        conflicts = set(conflicts)
+        best = None
+        best_names = frozenset()
+        for (names, closure_conflicts), closure in self.precomputed.items():
+            if len(names) <= len(best_names):
+                continue
+            if names <= pkg_names and closure_conflicts <= conflicts:
+                best = closure
+                best_names = names
+        return best, best_names
+
+    def get_precomputed(self, pkg_names, conflicts):
+        ''' Returns what resolve would return for pkg_names if we have
+        been given a closure of them (or of part of them, then the rest is
+        resolved here) that matches our sync dbs, None if not '''
+        closure, closure_names = self.find_precomputed(pkg_names, conflicts)
+        if closure == None:
+            return None
+
+        index = PackageIndex(self.handle.get_syncdbs(), conflicts)
+        to_add = []
+        for entry in closure['packages']:
+            pkg = index.get_pkg(entry['name'])
+            if pkg == None or pkg.version != entry['version'] or pkg.name in conflicts:
+                return None
+            to_add.append(pkg)
+
+        localdb = self.handle.get_localdb()
+        to_remove = []
+        for name in closure['to_remove']:
+            pkg = localdb.get_pkg(name)
+            if pkg != None:
+                to_remove.append(pkg)
+
+        explicit = list(closure['explicit'])
+
+        remainder = [ name for name in pkg_names if name not in closure_names ]
+        if len(remainder) == 0:
+            return to_add, to_remove, explicit
+
+        more_to_add, more_to_remove, more_explicit = self.resolve_transaction(remainder, conflicts)
+        if len(more_to_add) == 0:
+            return None
+
+        added = set(pkg.name for pkg in to_add)
+        more_to_add = [ pkg for pkg in more_to_add if pkg.name not in added ]
+
+        # The closure was resolved without the rest of the packages. If they
+        # don't get along (nvidia-libgl and mesa-libgl...) it isn't valid
+        if has_conflicts(to_add, more_to_add):
+            return None
+
+        removed = set(pkg.name for pkg in to_remove)
+        to_add.extend(more_to_add)
+        to_remove.extend(pkg for pkg in more_to_remove if pkg.name not in removed)
+        explicit.extend(name for name in more_explicit if name not in explicit)
+        return to_add, to_remove, explicit
+
+    def resolve(self, pkg_names, conflicts):
+        ''' Prepares (but doesn't commit) a transaction with pkg_names.
+        Returns the packages to be installed, the ones to be removed and
+        the names of the ones that have been explicitly asked for '''
+        precomputed = self.get_precomputed(pkg_names, conflicts)
+        if precomputed != None:
+            return precomputed
+        return self.resolve_transaction(pkg_names, conflicts)
+
+    def resolve_transaction(self, pkg_names, conflicts):
+        ''' Like resolve, but always asks libalpm '''
+        self.release_transaction()
+        self.conflicts = conflicts
+
+        old_listofpackages = self.listofpackages
+        self.listofpackages = []
+
+        to_add = []
+        to_remove = []
+        explicit = []
+
+        self.t = self.init_transaction()
+        if self.t != None:
+            for pkgname in pkg_names:
+                self.add_package(pkgname)
+            explicit = [ pkg.name for pkg in self.listofpackages ]
+            try:
+                self.t.prepare()
+                to_add = list(self.t.to_add)
+                to_remove = list(self.t.to_remove)
+            except pyalpm.error:
+                self.queue_event("error", traceback.format_exc())
+            self.release_transaction()
+
+        self.listofpackages = old_listofpackages
+
+        return to_add, to_remove, explicit
+
+    def get_install_order(self, pkg_names, conflicts):
+        ''' Resolves pkg_names and their dependencies without installing
+        anything. Returns all packages to be installed sorted in dependency
+        order, and the names of the ones that have been explicitly asked for '''
+        to_add, to_remove, explicit = self.resolve(pkg_names, conflicts)
+        return sort_by_dependencies(to_add), explicit
+
+    def plan(self, pkg_names, conflicts, extra=None):
+        ''' Tells what installing pkg_names would do, without doing it.
+        Returns a dict with the packages to install (and their download and
+        installed sizes), the packages to remove, the totals, and the space
+        needed and available in each mount point involved.
+
+        Sync dbs don't have file lists, so the installed size of all
+        packages is accounted to the filesystem of RootDir/usr and the
+        download size to the one of the first CacheDir. extra is a list of
+        (path, size) with more space that will be needed while installing '''
+        to_add, to_remove, explicit = self.resolve(pkg_names, conflicts)
+
+        packages = []
+        download_size = 0
+        installed_size = 0
+        for pkg in sort_by_dependencies(to_add):
+            packages.append({
+                'name': pkg.name,
+                'version': pkg.version,
+                'repo': pkg.db.name,
+                'download_size': pkg.download_size,
+                'installed_size': pkg.isize })
+            download_size += pkg.download_size
+            installed_size += pkg.isize
+
+        root_dir = self.pacman_conf.options["RootDir"]
+        cache_dir = self.pacman_conf.options["CacheDir"][0]
+
+        space = {}
+        needs = [ (os.path.join(root_dir, "usr"), installed_size), (cache_dir, download_size) ]
+        if extra != None:
+            needs += extra
+        for path, size in needs:
+            mount_point = get_mount_point(path)
+            if mount_point not in space:
+                space[mount_point] = { 'needed': 0, 'free': get_free_space(mount_point) }
+            space[mount_point]['needed'] += size
+
+        self.installed_sizes = {}
+        for package in packages:
+            self.installed_sizes[package['name']] = package['installed_size']
+        self.installed_total = installed_size
+        self.installed_done = 0
+
+        return {
+            'packages': packages,
+            'explicit': explicit,
+            'to_remove': [ pkg.name for pkg in to_remove ],
+            'download_size': download_size,
+            'installed_size': installed_size,
+            'space': space }
+
+    def get_download_queue(self, pkgs):
+        ''' Returns the files to download to install pkgs, with the urls
+        of all the servers of their repos '''
+        download_queue = []
+        for pkg in pkgs:
+            servers = self.pacman_conf.get_servers(pkg.db.name)
+            download_queue.append({
+                'name': pkg.name,
+                'version': pkg.version,
+                'filename': pkg.filename,
+                'size': pkg.size,
+                'md5sum': pkg.md5sum,
+                'sha256sum': pkg.sha256sum,
+                'urls': [ "%s/%s" % (server, pkg.filename) for server in servers ] })
+        return download_queue
+
+    def find_missing(self, pkg_names, conflicts):
+        ''' Returns the packages (and dependencies) needed to install
+        pkg_names that are not in any sync db '''
+        index = PackageIndex(self.handle.get_syncdbs(), conflicts)
+        return index.find_missing(pkg_names)
+
+    def get_stage_sizes(self, stages, conflicts):
+        ''' stages is a list of package name lists, installed in that order.
+        Returns the installed size of the packages each stage adds (the
+        ones not pulled in by an earlier stage) '''
+        index = PackageIndex(self.handle.get_syncdbs(), conflicts)
+        sizes = []
+        seen = set()
+        for pkg_names in stages:
+            closure = index.get_closure(pkg_names, seen)
+            seen.update(pkg.name for pkg in closure)
+            sizes.append(sum(pkg.isize for pkg in closure))
+        return sizes
+
+    def get_package_names(self, pkg_names, conflicts):
+        ''' Returns the names of the packages pkg_names stand for (the
+        members of a group instead of the group name) '''
+        index = PackageIndex(self.handle.get_syncdbs(), conflicts)
+        names = []
+        for pkgname in pkg_names:
+            names.extend(pkg.name for pkg in index.lookup(pkgname))
+        return names
+
+    def set_reason(self, pkg_names, reason):
+        localdb = self.handle.get_localdb()
+        for pkgname in pkg_names:
+            pkg = localdb.get_pkg(pkgname)
+            if pkg == None:
+                continue
+            try:
+                self.handle.set_pkgreason(pkg, reason)
+            except pyalpm.error:
+                self.queue_event("warning", traceback.format_exc())
+
+    def mark_as_dependencies(self, pkg_names):
+        ''' Sets the install reason of already installed packages
+        to 'installed as a dependency' '''
+        self.set_reason(pkg_names, pyalpm.PKG_REASON_DEPEND)
+
+    def mark_as_explicit(self, pkg_names):
+        ''' Sets the install reason of already installed packages to
+        'explicitly installed' (for instance, packages asked for by a stage
+        that were already installed as dependencies of an earlier one) '''
+        self.set_reason(pkg_names, pyalpm.PKG_REASON_EXPLICIT)
+
     def add_package(self, pkgname):
         #print("searching %s" % pkgname)
         if self.t == None:
             return
         try:
-            for repo in self.handle.get_syncdbs():
-                if pkgname not in self.conflicts:
-                    pkg = repo.get_pkg(pkgname)
-                    if pkg:
-                        #print("adding %s" % pkgname)
-                        if pkg not in self.listofpackages:
-                            self.listofpackages.append(pkg)
-                            self.t.add_pkg(pkg)
-                        break
-                    else:
-                        # Couldn't find package in repo, 
-                        # maybe it's a group of packages.
-                        group_list = self.select_from_groups([repo], pkgname)
-                        if group_list:
-                            for pkg_group in group_list:
-                                if pkg_group not in self.listofpackages and \
-                                    pkg_group not in self.conflicts:
-                                    self.listofpackages.append(pkg_group)
-                                    self.t.add_pkg(pkg_group)
-                            break
+            # pkgname may be a package or a group of packages
+            for pkg in self.get_index().add(pkgname):
+                #print("adding %s" % pkgname)
+                self.listofpackages.append(pkg)
+                self.t.add_pkg(self.get_local_pkg(pkg))
         except pyalpm.error:
             line = traceback.format_exc()
             if "pm_errno 25" in line:
@@ -185,6 +740,17 @@ class Pac(object):
             else:
                 self.queue_event("error", line)
 
+    def get_local_pkg(self, pkg):
+        ''' Returns the package loaded from its local file, if there is one '''
+        path = self.local_files.get(pkg.filename)
+        if path == None:
+            return pkg
+        try:
+            return self.handle.load_pkg(path)
+        except pyalpm.error:
+            self.queue_event("debug", "Can't load %s, using the cached package" % path)
+            return pkg
+
     def select_from_groups(self, repos, pkg_group):
         pkgs_in_group = []
         for repo in repos:
@@ -211,6 +777,23 @@ class Pac(object):
             self.callback_queue.put_nowait((event_type, event_text))
         except queue.Full:
             pass
+
+    def queue_progress_event(self, event_type, event_text=""):
+        ''' Like queue_event, but sends at most one event of each type every
+        _progress_interval seconds. Skipped events are not lost: the newest
+        one is sent later (see flush_progress_events) '''
+        now = time.time()
+        if now - self.last_progress_time.get(event_type, 0) < _progress_interval:
+            self.pending_events[event_type] = event_text
+            return
+        self.last_progress_time[event_type] = now
+        self.pending_events.pop(event_type, None)
+        self.queue_event(event_type, event_text)
+
+    def flush_progress_events(self):
+        for event_type, event_text in self.pending_events.items():
+            self.queue_event(event_type, event_text)
+        self.pending_events = {}
          
     # Callback functions 
     def cb_event(self, ID, event, tupel):
@@ -243,6 +826,9 @@ class Pac(object):
         else:
             self.action = ''
 
+        # Don't let an old progress event overwrite this one
+        self.flush_progress_events()
+
         if len(self.action) > 0:
             self.queue_event("action", self.action)
         #self.queue_event("target", '')
@@ -261,6 +847,12 @@ class Pac(object):
         if not (level & _logmask):
             return
 
+        match = _failed_download_re.search(line)
+        if match != None:
+            target, host = match.groups()
+            self.mirror_scores.add_failure(host)
+            self.failed_hosts.setdefault(target, set()).add(host)
+
         if level & pyalpm.LOG_ERROR:
             self.error = _("ERROR: %s") % line
             print(line)
@@ -296,30 +888,32 @@ class Pac(object):
 
     def cb_dl(self, _target, _transferred, total):
         if self.t != None:
+            fraction = 0
             if self.total_size > 0:
                 fraction = (_transferred + self.already_transferred) / self.total_size
-            size = 0
-            if self.t.to_remove or self.t.to_add:
-                for pkg in self.t.to_remove + self.t.to_add:
-                    if pkg.name + '-' + pkg.version in _target:
-                        size = pkg.size
-                if _transferred == size:
-                    self.already_transferred += size
-                fsize = self.get_size(self.total_size)
+            if len(self.target_sizes) > 0:
+                size = self.target_sizes.get(_target, 0)
+                if _target not in self.download_start:
+                    self.download_start[_target] = time.time()
                 self.action = _('Downloading %s...') % _target
                 self.target = _target
                 if fraction > 1:
                     self.percent = 0
                 else:
                     self.percent = math.floor(fraction * 100) / 100
-                self.queue_event("action", self.action)
-                self.queue_event("percent", self.percent)
+                self.queue_progress_event("action", self.action)
+                self.queue_progress_event("percent", self.percent)
+                if _transferred == size:
+                    self.already_transferred += size
+                    self.add_download_score(_target, size)
+                    # Always show that a file has been downloaded
+                    self.flush_progress_events()
             else:
                 self.action = _('Refreshing %s...') % _target
                 self.target = _target
                 # can't we know which percent has 'refreshed' ?
                 self.percent = 0
-                self.queue_event("action", self.action)
+                self.queue_progress_event("action", self.action)
                 #self.queue_event("percent", self.percent)
 
     def cb_progress(self, _target, _percent, n, i):
@@ -327,6 +921,15 @@ class Pac(object):
             self.target = "Installing %s (%d/%d)" % (_target, i, n)
         else:
             self.target = "Checking and loading packages..."
-        self.percent = _percent / 100
-        self.queue_event("target", self.target)
-        self.queue_event("percent", self.percent)
\ No newline at end of file
+
+        if _target in self.installed_sizes and self.installed_total > 0:
+            # Weight each package by its installed size (see plan)
+            size = self.installed_sizes[_target]
+            self.percent = (self.installed_done + size * _percent / 100) / self.installed_total
+            if _percent == 100:
+                self.installed_done += size
+                del self.installed_sizes[_target]
+        else:
+            self.percent = _percent / 100
+        self.queue_progress_event("target", self.target)
+        self.queue_progress_event("percent", self.percent)
\ No newline at end of file
@@ -39,6 +39,7 @@ import sys
 import argparse
 import collections
 import warnings
+import types
 
 import pyalpm
 
@@ -86,33 +87,54 @@ BOOLEAN_OPTIONS = (
     'Color'
 )
 
+# Parsed config files, keyed by (path, mtime, size). The mirrorlist is
+# included by every repo section, this way it's only read once
+_parsed_files = {}
+
+def read_conf_file(path):
+    ''' Returns the meaningful lines (no comments, no blank lines) of a
+    config file. The file is only read again if it changes '''
+    st = os.stat(path)
+    key = (path, st.st_mtime, st.st_size)
+    lines = _parsed_files.get(key)
+    if lines is None:
+        lines = []
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if len(line) > 0 and line[0] != '#':
+                    lines.append(line)
+        lines = tuple(lines)
+        # Forget older versions of this file
+        for old_key in [ k for k in _parsed_files if k[0] == path ]:
+            del _parsed_files[old_key]
+        _parsed_files[key] = lines
+    return lines
+
 def pacman_conf_enumerator(path):
     filestack = []
     current_section = None
-    filestack.append(open(path))
+    filestack.append((path, iter(read_conf_file(path))))
     while len(filestack) > 0:
-        f = filestack[-1]
-        line = f.readline()
-        if len(line) == 0:
+        filename, lines = filestack[-1]
+        line = next(lines, None)
+        if line is None:
             # end of file
             filestack.pop()
             continue
 
-        line = line.strip()
-        if len(line) == 0: continue
-        if line[0] == '#':
-            continue
         if line[0] == '[' and line[-1] == ']':
             current_section = line[1:-1]
             continue
         if current_section is None:
-            raise InvalidSyntax(f.name, 'statement outside of a section', line)
+            raise InvalidSyntax(filename, 'statement outside of a section', line)
         # read key, value
         key, equal, value = [x.strip() for x in line.partition('=')]
 
-        # include files
+        # include files (the first one must be read first)
         if equal == '=' and key == 'Include':
-            filestack.extend(open(f) for f in glob.glob(value))
+            for include in reversed(sorted(glob.glob(value))):
+                filestack.append((include, iter(read_conf_file(include))))
             continue
         if current_section != 'options':
             # repos only have the Server option
@@ -121,7 +143,7 @@ def pacman_conf_enumerator(path):
             elif key == 'SigLevel' and equal == '=':
                 yield (current_section, 'SigLevel', value)
             else:
-                raise InvalidSyntax(f.name, 'invalid key for repository configuration', line)
+                raise InvalidSyntax(filename, 'invalid key for repository configuration', line)
             continue
         if equal == '=':
             if key in LIST_OPTIONS:
@@ -130,12 +152,12 @@ def pacman_conf_enumerator(path):
             elif key in SINGLE_OPTIONS:
                 yield (current_section, key, value)
             else:
-                warnings.warn(InvalidSyntax(f.name, 'unrecognized option', key))
+                warnings.warn(InvalidSyntax(filename, 'unrecognized option', key))
         else:
             if key in BOOLEAN_OPTIONS:
                 yield (current_section, key, True)
             else:
-                warnings.warn(InvalidSyntax(f.name, 'unrecognized option', key))
+                warnings.warn(InvalidSyntax(filename, 'unrecognized option', key))
 
 class PacmanConfig(object):
     def __init__(self, conf = None, options = None):
@@ -185,34 +207,92 @@ class PacmanConfig(object):
             _logmask = 0xffff
 
     def apply(self, h):
-        h.arch = self.options["Architecture"]
-        h.logfile = self.options["LogFile"]
-        h.gpgdir = self.options["GPGDir"]
-        h.cachedirs = self.options["CacheDir"]
-        if "IgnoreGroup" in self.options:
-            h.ignoregrps = self.options["IgnoreGroup"]
-        if "IgnorePkg" in self.options:
-            h.ignorepkgs = self.options["IgnorePkg"]
-        if "NoExtract" in self.options:
-            h.noextracts = self.options["NoExtract"]
-        if "NoUpgrade" in self.options:
-            h.noupgrades = self.options["NoUpgrade"]
-
-        # set sync databases
-        for repo, servers in self.repos.items():
-            db = h.register_syncdb(repo, 0)
-            db_servers = []
-            for rawurl in servers:
-                url = rawurl.replace("$repo", repo)
-                url = url.replace("$arch", self.options["Architecture"])
-                db_servers.append(url)
-            db.servers = db_servers
+        apply_config(self, h)
+
+    def get_servers(self, repo):
+        ''' Returns the server urls of a repo ($repo and $arch replaced) '''
+        return get_servers(self, repo)
 
     def initialize_alpm(self):
         h = pyalpm.Handle(self.options["RootDir"], self.options["DBPath"])
         self.apply(h)
         return h
 
+    def freeze(self):
+        ''' Returns a read only copy of this config '''
+        return FrozenPacmanConfig(self.options, self.repos)
+
     def __str__(self):
         return("PacmanConfig(options=%s, repos=%s)" % (str(self.options), str(self.repos)))
 
+class FrozenPacmanConfig(object):
+    ''' Read only PacmanConfig. It can be shared (and pickled, to send it
+    to other processes) instead of parsing pacman.conf again '''
+    def __init__(self, options, repos):
+        frozen_options = {}
+        for key, value in options.items():
+            if isinstance(value, list):
+                value = tuple(value)
+            frozen_options[key] = value
+        self._options = frozen_options
+        self._repos = tuple((repo, tuple(servers)) for repo, servers in repos.items())
+
+    @property
+    def options(self):
+        return types.MappingProxyType(self._options)
+
+    @property
+    def repos(self):
+        return collections.OrderedDict(self._repos)
+
+    def __reduce__(self):
+        return (FrozenPacmanConfig, (self._options, collections.OrderedDict(self._repos)))
+
+    def __eq__(self, other):
+        return isinstance(other, FrozenPacmanConfig) and \
+            self._options == other._options and self._repos == other._repos
+
+    def __hash__(self):
+        return hash(self._repos)
+
+    def apply(self, h):
+        apply_config(self, h)
+
+    def get_servers(self, repo):
+        ''' Returns the server urls of a repo ($repo and $arch replaced) '''
+        return get_servers(self, repo)
+
+    def initialize_alpm(self):
+        h = pyalpm.Handle(self.options["RootDir"], self.options["DBPath"])
+        self.apply(h)
+        return h
+
+    def __str__(self):
+        return("FrozenPacmanConfig(options=%s, repos=%s)" % (str(self._options), str(self._repos)))
+
+def apply_config(conf, h):
+    h.arch = conf.options["Architecture"]
+    h.logfile = conf.options["LogFile"]
+    h.gpgdir = conf.options["GPGDir"]
+    h.cachedirs = list(conf.options["CacheDir"])
+    if "IgnoreGroup" in conf.options:
+        h.ignoregrps = list(conf.options["IgnoreGroup"])
+    if "IgnorePkg" in conf.options:
+        h.ignorepkgs = list(conf.options["IgnorePkg"])
+    if "NoExtract" in conf.options:
+        h.noextracts = list(conf.options["NoExtract"])
+    if "NoUpgrade" in conf.options:
+        h.noupgrades = list(conf.options["NoUpgrade"])
+
+    # set sync databases
+    for repo in conf.repos:
+        db = h.register_syncdb(repo, 0)
+        db.servers = conf.get_servers(repo)
+
+def get_servers(conf, repo):
+    db_servers = []
+    for rawurl in conf.repos.get(repo, []):
+        url = rawurl.replace("$repo", repo)
+        url = url.replace("$arch", conf.options["Architecture"])
+        db_servers.append(url)
+    return db_servers
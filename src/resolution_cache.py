@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  resolution_cache.py
+#
+#  Copyright 2013 Antergos
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#  Antergos Team:
+#   Alex Filgueira (faidoc) <alexfilgueira.antergos.com>
+#   Raúl Granados (pollitux) <raulgranados.antergos.com>
+#   Gustau Castells (karasu) <karasu.antergos.com>
+#   Kirill Omelchenko (omelcheck) <omelchek.antergos.com>
+#   Marc Miralles (arcnexus) <arcnexus.antergos.com>
+#   Alex Skinner (skinner) <skinner.antergos.com>
+
+''' Stores resolved download queues so a repeated install (for instance,
+a retry after a failed one) doesn't have to resolve dependencies again.
+
+Entries are keyed by the contents of the sync databases, the requested
+package list and the conflicts list. When the databases change, all
+entries made with the old ones are removed. '''
+
+import os
+import glob
+import json
+import hashlib
+
+import log
+
+def hash_databases(databases_dir):
+    ''' Returns a hash of the contents of all sync databases in databases_dir '''
+    db_hash = hashlib.sha256()
+    for path in sorted(glob.glob(os.path.join(databases_dir, "*.db"))):
+        db_hash.update(os.path.basename(path).encode())
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(65536), b''):
+                db_hash.update(block)
+    return db_hash.hexdigest()
+
+class ResolutionCache(object):
+    def __init__(self, cache_dir, databases_dir):
+        self.cache_dir = cache_dir
+        self.databases_dir = databases_dir
+        self.db_hash = None
+
+    def get_db_hash(self):
+        if self.db_hash == None:
+            self.db_hash = hash_databases(self.databases_dir)
+        return self.db_hash
+
+    def invalidate(self):
+        ''' Must be called if the sync databases change '''
+        self.db_hash = None
+
+    def get_key(self, package_names, conflicts):
+        key = hashlib.sha256()
+        key.update(self.get_db_hash().encode())
+        key.update("\n".join(sorted(set(package_names))).encode())
+        key.update(b"\0")
+        key.update("\n".join(sorted(set(conflicts))).encode())
+        return key.hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, key + ".json")
+
+    def get(self, package_names, conflicts):
+        ''' Returns the cached download queue or None if there isn't one '''
+        path = self.get_path(self.get_key(package_names, conflicts))
+        try:
+            with open(path, "rt") as f:
+                entry = json.load(f)
+        except (IOError, ValueError):
+            return None
+
+        if entry.get('db_hash') != self.get_db_hash():
+            return None
+
+        return entry['queue']
+
+    def put(self, package_names, conflicts, download_queue):
+        self.evict_stale()
+        entry = { 'db_hash': self.get_db_hash(), 'queue': download_queue }
+        path = self.get_path(self.get_key(package_names, conflicts))
+        try:
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            with open(path + ".part", "wt") as f:
+                json.dump(entry, f)
+            os.rename(path + ".part", path)
+        except (IOError, OSError) as e:
+            log.debug(_("Can't store resolved download queue: %s") % e)
+
+    def evict_stale(self):
+        ''' Removes all entries made with other sync databases '''
+        db_hash = self.get_db_hash()
+        for path in glob.glob(os.path.join(self.cache_dir, "*.json")):
+            try:
+                with open(path, "rt") as f:
+                    stale = (json.load(f).get('db_hash') != db_hash)
+            except (IOError, ValueError):
+                stale = True
+            if stale:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
@@ -39,6 +39,7 @@ import show_message as show
 import log
 import subprocess
 import misc
+import download_telemetry
 
 # when we reach this page we can't go neither backwards nor forwards
 _next_page = None
@@ -161,6 +162,8 @@ class Slides(Gtk.Box):
                 return False
             elif event[0] == "error":
                 show.fatal_error(event[1])
+            elif event[0] == "download_stats":
+                self.set_message(download_telemetry.format_stats(event[1]))
             else:
                 #with self.lock:
                 log.debug(event[1])
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  task_scheduler.py
+#
+#  Copyright 2013 Antergos
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#  Antergos Team:
+#   Alex Filgueira (faidoc) <alexfilgueira.antergos.com>
+#   Raúl Granados (pollitux) <raulgranados.antergos.com>
+#   Gustau Castells (karasu) <karasu.antergos.com>
+#   Kirill Omelchenko (omelcheck) <omelchek.antergos.com>
+#   Marc Miralles (arcnexus) <arcnexus.antergos.com>
+#   Alex Skinner (skinner) <skinner.antergos.com>
+
+
+''' Runs a set of tasks with dependencies between them. A task starts as
+soon as all the tasks it depends on have finished, using a bounded pool
+of worker threads, so independent tasks run at the same time.
+
+The time each task takes is recorded, and get_summary() shows the
+critical path (the chain of tasks that determined the total time). '''
+
+import time
+import concurrent.futures
+
+import log
+
+class TaskError(Exception):
+    pass
+
+class Task(object):
+    def __init__(self, name, func, deps):
+        self.name = name
+        self.func = func
+        self.deps = list(deps)
+        self.start = None
+        self.end = None
+
+    def get_duration(self):
+        if self.start == None or self.end == None:
+            return 0
+        return self.end - self.start
+
+class TaskScheduler(object):
+    def __init__(self, workers=4):
+        self.workers = workers
+        self.tasks = {}
+        # Tasks in the order they were added (used to break ties)
+        self.order = []
+        self.start = None
+        self.end = None
+
+    def add(self, name, func, deps=None):
+        ''' Adds a task. func is called without arguments once all tasks
+        named in deps have finished '''
+        if name in self.tasks:
+            raise TaskError("Task '%s' already exists" % name)
+        self.tasks[name] = Task(name, func, deps or [])
+        self.order.append(name)
+
+    def check(self):
+        ''' Checks that all dependencies exist and that there are no cycles '''
+        for task in self.tasks.values():
+            for dep in task.deps:
+                if dep not in self.tasks:
+                    raise TaskError("Task '%s' depends on unknown task '%s'" % (task.name, dep))
+
+        # 0: not visited, 1: visiting, 2: done
+        state = dict.fromkeys(self.tasks, 0)
+
+        def visit(name):
+            if state[name] == 1:
+                raise TaskError("Dependency cycle found at task '%s'" % name)
+            if state[name] == 0:
+                state[name] = 1
+                for dep in self.tasks[name].deps:
+                    visit(dep)
+                state[name] = 2
+
+        for name in self.order:
+            visit(name)
+
+    def run_task(self, task):
+        task.start = time.time()
+        log.debug(_("Task '%s' started") % task.name)
+        try:
+            task.func()
+        finally:
+            task.end = time.time()
+            log.debug(_("Task '%s' finished (%.1f seconds)") % (task.name, task.get_duration()))
+
+    def run(self):
+        ''' Runs all tasks. If one of them fails, no more tasks are started
+        and its exception is raised right away: tasks still running are not
+        waited for (they may be waiting for the user) '''
+        self.check()
+        self.start = time.time()
+
+        done = set()
+        running = {}
+        error = None
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            while error == None:
+                for name in self.order:
+                    task = self.tasks[name]
+                    if name in done or task in running.values():
+                        continue
+                    if all(dep in done for dep in task.deps):
+                        running[executor.submit(self.run_task, task)] = task
+
+                if len(running) == 0:
+                    break
+
+                finished, pending = concurrent.futures.wait(running.keys(), \
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    task = running.pop(future)
+                    try:
+                        future.result()
+                        done.add(task.name)
+                    except Exception as e:
+                        if error == None:
+                            error = e
+        finally:
+            if error != None:
+                for future, task in running.items():
+                    if not future.cancel():
+                        log.debug(_("Not waiting for task '%s'") % task.name)
+            executor.shutdown(wait=(error == None))
+
+        self.end = time.time()
+
+        if error != None:
+            raise error
+
+        if len(done) != len(self.tasks):
+            raise TaskError("Not all tasks could be run")
+
+    def get_critical_path(self):
+        ''' Returns the tasks (in order) whose durations added up to the
+        total time: the last task to finish, the dependency of that task
+        that finished last, and so on '''
+        finished = [ task for task in self.tasks.values() if task.end != None ]
+        if len(finished) == 0:
+            return []
+
+        path = []
+        task = max(finished, key=lambda t: t.end)
+        while task != None:
+            path.append(task)
+            deps = [ self.tasks[dep] for dep in task.deps if self.tasks[dep].end != None ]
+            if len(deps) > 0:
+                task = max(deps, key=lambda t: t.end)
+            else:
+                task = None
+        path.reverse()
+        return path
+
+    def get_summary(self):
+        ''' Returns a text with the total time, the time all tasks would
+        have taken one after the other and the critical path '''
+        total = 0
+        if self.start != None and self.end != None:
+            total = self.end - self.start
+        sequential = sum(task.get_duration() for task in self.tasks.values())
+
+        path = self.get_critical_path()
+        steps = [ "%s (%.1fs)" % (task.name, task.get_duration()) for task in path ]
+
+        return "Tasks took %.1f seconds (%.1f seconds one after the other). Critical path: %s" % \
+            (total, sequential, " -> ".join(steps))
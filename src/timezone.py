@@ -100,7 +100,8 @@ class Timezone(Gtk.Box):
 
         # thread to try to determine timezone.
         self.auto_timezone_thread = None
-        self.start_auto_timezone_thread()
+        if not self.settings.get("offline"):
+            self.start_auto_timezone_thread()
         
         # thread to generate a pacman mirrorlist based on country code
         # Why do this? There're foreign mirrors faster than the Spanish ones... - Karasu